@@ -19,6 +19,10 @@ class ConfigV3:
         self.documents_dir = self._base.documents_dir
         self.chunk_size = self._base.chunk_size
         self.chunk_overlap = self._base.chunk_overlap
+        # 并行加载文档的进程数（默认 CPU 核数 - 1）
+        self.load_workers = int(
+            os.getenv("V3_LOAD_WORKERS", str(max(1, (os.cpu_count() or 2) - 1)))
+        )
 
         # v3 向量库配置（使用单独的持久化目录 / 集合名，避免和 v2 冲突）
         self.chroma_persist_directory = os.getenv(
@@ -28,6 +32,23 @@ class ConfigV3:
             "V3_COLLECTION_NAME", "rag_v3_knowledge_base"
         )
 
+        # HNSW 索引参数（仅在新建集合时生效；search_ef 越大召回越高、检索越慢）
+        self.hnsw_m = int(os.getenv("V3_HNSW_M", "32"))
+        self.hnsw_construction_ef = int(os.getenv("V3_HNSW_CONSTRUCTION_EF", "200"))
+        self.hnsw_search_ef = int(os.getenv("V3_HNSW_SEARCH_EF", "64"))
+        # 写入缓冲达到该数量后才同步到磁盘上的 HNSW 索引, 批量入库时减少索引持久化次数
+        self.hnsw_sync_threshold = int(os.getenv("V3_HNSW_SYNC_THRESHOLD", "10000"))
+
+        # 入库批大小: 每批文本向量化后写入 Chroma, 下一批的向量化与本批写入重叠进行
+        self.ingest_batch_size = int(os.getenv("V3_INGEST_BATCH_SIZE", "512"))
+
+        # int8 量化粗排: 在内存中保存 int8 向量矩阵做初筛, 再用原始 FP32 向量精排
+        self.use_int8_embed = os.getenv("USE_INT8_EMBED", "false").lower() in ("1", "true", "yes")
+
+        # MMR 候选数量，未设置时为 k 的 3 倍
+        fetch_k = os.getenv("V3_FETCH_K")
+        self.retrieval_fetch_k = int(fetch_k) if fetch_k else None
+
         # PDF 页图导出目录
         self.page_image_dir = os.getenv(
             "V3_PAGE_IMAGE_DIR", "./data_base_v3/page_images"
@@ -49,12 +70,19 @@ class ConfigV3:
             "documents_dir": self.documents_dir,
             "chunk_size": self.chunk_size,
             "chunk_overlap": self.chunk_overlap,
+            "load_workers": self.load_workers,
         }
 
-    def get_vectorstore_config(self) -> Dict[str, str]:
+    def get_vectorstore_config(self) -> Dict[str, object]:
         return {
             "persist_directory": self.chroma_persist_directory,
             "collection_name": self.collection_name,
+            "hnsw_m": self.hnsw_m,
+            "hnsw_construction_ef": self.hnsw_construction_ef,
+            "hnsw_search_ef": self.hnsw_search_ef,
+            "hnsw_sync_threshold": self.hnsw_sync_threshold,
+            "use_int8_embed": self.use_int8_embed,
+            "ingest_batch_size": self.ingest_batch_size,
         }
 
     def get_gemini_config(self) -> Dict[str, str]:
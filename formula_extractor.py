@@ -3,11 +3,67 @@ PDF公式提取器
 识别和提取数学公式,并渲染为高清图像
 """
 import fitz  # PyMuPDF
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterator
+import functools
+import json
 import os
 import re
 
 
+_MATH_SYMBOLS = ['∫', '∑', '∏', '√', '∂', '∇', '≈', '≤', '≥', '±', '×', '÷', '∞', 'π', 'Δ', 'α', 'β', 'γ', 'θ', 'ω']
+
+# _is_formula_text 的每条规则都至少需要以下字符之一, 页面纯文本中都不含时可整页跳过
+_FORMULA_TRIGGER_CHARS = frozenset(['=', '/', '_', '^', '+', '-', '*'] + _MATH_SYMBOLS)
+
+
+@functools.lru_cache(maxsize=4096)
+def _is_formula_text(text: str) -> bool:
+    """
+    判断文本块是否为公式
+    
+    使用多种启发式规则:
+    1. 包含等号且较短
+    2. 包含数学符号
+    3. 包含分数形式
+    4. 包含上下标标记
+    """
+    # 规则1: 包含等号且长度适中(避免普通句子)
+    if '=' in text and 10 < len(text) < 200:
+        # 检查是否有数学特征
+        # 包含变量(单个大写字母或带下标)
+        if re.search(r'\b[A-Z]\b|[A-Za-z]_[A-Za-z0-9]', text):
+            return True
+    
+    # 规则2: 包含数学符号
+    if any(sym in text for sym in _MATH_SYMBOLS):
+        return True
+    
+    # 规则3: 包含分数形式(如"V/R", "1/2C")
+    if re.search(r'[A-Za-z0-9]+\s*/\s*[A-Za-z0-9]+', text):
+        # 排除日期(如"2024/12/08")
+        if not re.search(r'\d{4}/\d{1,2}/\d{1,2}', text):
+            return True
+    
+    # 规则4: 包含上下标标记(如"V_out", "x^2")
+    if re.search(r'[A-Za-z]_[A-Za-z0-9]|[A-Za-z]\^[0-9]', text):
+        return True
+    
+    # 规则5: 包含括号且有数学运算符
+    if '(' in text and ')' in text:
+        if any(op in text for op in ['+', '-', '*', '/', '=']):
+            # 检查是否有变量
+            if re.search(r'\b[A-Z]\b', text):
+                return True
+    
+    # 规则6: 短文本且包含多个数学运算符
+    if len(text) < 100:
+        op_count = sum(text.count(op) for op in ['+', '-', '*', '/', '='])
+        if op_count >= 2:
+            return True
+    
+    return False
+
+
 class FormulaExtractor:
     """PDF公式提取器"""
     
@@ -26,6 +82,9 @@ class FormulaExtractor:
         """
         提取PDF中的公式
         
+        兼容接口: 收集 extract_formulas_iter 的结果后一次返回整个列表;
+        大文档或批量处理时请直接使用 extract_formulas_iter 逐个处理, 避免在内存中累积整份文档的结果
+        
         策略:
         1. 基于文本特征识别公式区域(包含=, ∫, Σ等符号)
         2. 渲染该区域为高清图像
@@ -46,73 +105,90 @@ class FormulaExtractor:
                 'source': '/path/to/doc1.pdf'
             }
         """
+        return list(self.extract_formulas_iter(pdf_path))
+    
+    def extract_formulas_iter(self, pdf_path: str) -> Iterator[Dict]:
+        """
+        逐个生成PDF中的公式元数据 (不在内存中累积整份文档的结果)
+        
+        Args:
+            pdf_path: PDF文件路径
+            
+        Yields:
+            公式元数据字典, 格式同 extract_formulas
+        """
         if not os.path.exists(pdf_path):
             print(f"[FormulaExtractor] PDF文件不存在: {pdf_path}")
-            return []
+            return
         
         try:
             doc = fitz.open(pdf_path)
         except Exception as e:
             print(f"[FormulaExtractor] 打开PDF失败: {pdf_path}, 错误: {e}")
-            return []
+            return
         
-        formulas = []
+        count = 0
         base_name = os.path.splitext(os.path.basename(pdf_path))[0]
         
         print(f"[FormulaExtractor] 开始提取: {pdf_path} (共{len(doc)}页)")
         
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            
-            # 获取页面文本块
-            try:
-                blocks = page.get_text("dict")["blocks"]
-            except Exception as e:
-                print(f"[FormulaExtractor] 获取文本块失败 (页{page_num}): {e}")
-                continue
-            
-            for block_idx, block in enumerate(blocks):
-                # 跳过图像块
-                if block.get("type") != 0:
-                    continue
-                
-                # 提取文本
-                text = self._extract_block_text(block)
-                
-                # 判断是否为公式
-                if not text or not self._is_formula(text):
-                    continue
-                
-                # 获取边界框
-                bbox = block.get("bbox")
-                if not bbox:
-                    continue
-                
-                # 生成公式ID
-                formula_id = f"{base_name}_eq_p{page_num}_b{block_idx}"
-                
-                # 渲染公式区域为图像
-                image_path = self._render_formula_region(page, bbox, formula_id)
-                
-                if not image_path:
+        # 调用方提前停止迭代 (break/异常) 时也要关闭文档
+        try:
+            for page_num in range(len(doc)):
+                page = doc[page_num]
+
+                # 获取页面文本块 (先用纯文本探测, 不含任何公式特征字符的页面跳过结构化提取)
+                try:
+                    if _FORMULA_TRIGGER_CHARS.isdisjoint(page.get_text()):
+                        continue
+                    blocks = page.get_text("dict")["blocks"]
+                except Exception as e:
+                    print(f"[FormulaExtractor] 获取文本块失败 (页{page_num}): {e}")
                     continue
-                
-                # 提取上下文(前一个文本块)
-                context = self._extract_context(blocks, block_idx)
-                
-                formulas.append({
-                    'formula_id': formula_id,
-                    'page': page_num,
-                    'bbox': list(bbox),
-                    'image_path': image_path,
-                    'text': text.strip(),
-                    'context': context,
-                    'source': pdf_path
-                })
-        
-        doc.close()
-        print(f"[FormulaExtractor] 提取完成: {len(formulas)} 个公式")
-        return formulas
+
+                for block_idx, block in enumerate(blocks):
+                    # 跳过图像块
+                    if block.get("type") != 0:
+                        continue
+
+                    # 提取文本
+                    text = self._extract_block_text(block)
+
+                    # 判断是否为公式
+                    if not text or not self._is_formula(text):
+                        continue
+
+                    # 获取边界框
+                    bbox = block.get("bbox")
+                    if not bbox:
+                        continue
+
+                    # 生成公式ID
+                    formula_id = f"{base_name}_eq_p{page_num}_b{block_idx}"
+
+                    # 渲染公式区域为图像
+                    image_path = self._render_formula_region(page, bbox, formula_id)
+
+                    if not image_path:
+                        continue
+
+                    # 提取上下文(前一个文本块)
+                    context = self._extract_context(blocks, block_idx)
+
+                    count += 1
+                    yield {
+                        'formula_id': formula_id,
+                        'page': page_num,
+                        'bbox': list(bbox),
+                        'image_path': image_path,
+                        'text': text.strip(),
+                        'context': context,
+                        'source': pdf_path
+                    }
+        finally:
+            doc.close()
+
+        print(f"[FormulaExtractor] 提取完成: {count} 个公式")
     
     def _extract_block_text(self, block: Dict) -> str:
         """从文本块中提取文本"""
@@ -123,51 +199,8 @@ class FormulaExtractor:
         return text.strip()
     
     def _is_formula(self, text: str) -> bool:
-        """
-        判断文本块是否为公式
-        
-        使用多种启发式规则:
-        1. 包含等号且较短
-        2. 包含数学符号
-        3. 包含分数形式
-        4. 包含上下标标记
-        """
-        # 规则1: 包含等号且长度适中(避免普通句子)
-        if '=' in text and 10 < len(text) < 200:
-            # 检查是否有数学特征
-            # 包含变量(单个大写字母或带下标)
-            if re.search(r'\b[A-Z]\b|[A-Za-z]_[A-Za-z0-9]', text):
-                return True
-        
-        # 规则2: 包含数学符号
-        math_symbols = ['∫', '∑', '∏', '√', '∂', '∇', '≈', '≤', '≥', '±', '×', '÷', '∞', 'π', 'Δ', 'α', 'β', 'γ', 'θ', 'ω']
-        if any(sym in text for sym in math_symbols):
-            return True
-        
-        # 规则3: 包含分数形式(如"V/R", "1/2C")
-        if re.search(r'[A-Za-z0-9]+\s*/\s*[A-Za-z0-9]+', text):
-            # 排除日期(如"2024/12/08")
-            if not re.search(r'\d{4}/\d{1,2}/\d{1,2}', text):
-                return True
-        
-        # 规则4: 包含上下标标记(如"V_out", "x^2")
-        if re.search(r'[A-Za-z]_[A-Za-z0-9]|[A-Za-z]\^[0-9]', text):
-            return True
-        
-        # 规则5: 包含括号且有数学运算符
-        if '(' in text and ')' in text:
-            if any(op in text for op in ['+', '-', '*', '/', '=']):
-                # 检查是否有变量
-                if re.search(r'\b[A-Z]\b', text):
-                    return True
-        
-        # 规则6: 短文本且包含多个数学运算符
-        if len(text) < 100:
-            op_count = sum(text.count(op) for op in ['+', '-', '*', '/', '='])
-            if op_count >= 2:
-                return True
-        
-        return False
+        """判断文本块是否为公式 (结果按文本缓存, 见 _is_formula_text)"""
+        return _is_formula_text(text)
     
     def _render_formula_region(
         self, 
@@ -188,17 +221,13 @@ class FormulaExtractor:
         """
         try:
             # 扩展边界框(增加15%边距,确保公式完整)
-            x0, y0, x1, y1 = bbox
-            width = x1 - x0
-            height = y1 - y0
+            rect = fitz.Rect(bbox)
             margin = 0.15
+            dx = rect.width * margin
+            dy = rect.height * margin
             
-            clip_rect = fitz.Rect(
-                max(0, x0 - width * margin),
-                max(0, y0 - height * margin),
-                x1 + width * margin,
-                y1 + height * margin
-            )
+            # 扩展后与页面区域求交, 一次完成裁剪
+            clip_rect = (rect + (-dx, -dy, dx, dy)) & page.rect
             
             # 高分辨率渲染(300 DPI,确保公式清晰)
             mat = fitz.Matrix(300 / 72, 300 / 72)
@@ -231,42 +260,47 @@ class FormulaExtractor:
             if prev_block.get("type") == 0:  # 文本块
                 text = self._extract_block_text(prev_block)
                 # 取最后一句作为上下文
-                sentences = text.split('。')
-                if sentences:
-                    return sentences[-1].strip()[:100]
+                return text.rsplit('。', 1)[-1].strip()[:100]
         
         # 尝试获取后一个文本块
         if current_idx + 1 < len(blocks):
             next_block = blocks[current_idx + 1]
             if next_block.get("type") == 0:
                 text = self._extract_block_text(next_block)
-                sentences = text.split('。')
-                if sentences:
-                    return sentences[0].strip()[:100]
+                return text.split('。', 1)[0].strip()[:100]
         
         return ""
     
-    def extract_formulas_batch(self, pdf_dir: str) -> Dict[str, List[Dict]]:
+    def extract_formulas_batch(self, pdf_dir: str) -> Dict[str, int]:
         """
         批量提取目录下所有PDF的公式
         
+        公式元数据逐条写入 output_dir/formulas_index.jsonl (每行一个JSON),
+        不在内存中保留, 下游按行读取即可
+        
         Args:
             pdf_dir: PDF文件目录
             
         Returns:
-            {pdf_path: [formulas]}
+            {pdf_path: 公式数量}
         """
         results = {}
+        jsonl_path = os.path.join(self.output_dir, "formulas_index.jsonl")
         
-        for root, _, files in os.walk(pdf_dir):
-            for file in files:
-                if file.lower().endswith('.pdf'):
-                    pdf_path = os.path.join(root, file)
-                    formulas = self.extract_formulas(pdf_path)
-                    results[pdf_path] = formulas
+        with open(jsonl_path, 'w', encoding='utf-8') as f:
+            for root, _, files in os.walk(pdf_dir):
+                for file in files:
+                    if file.lower().endswith('.pdf'):
+                        pdf_path = os.path.join(root, file)
+                        count = 0
+                        for eq in self.extract_formulas_iter(pdf_path):
+                            f.write(json.dumps(eq, ensure_ascii=False) + "\n")
+                            count += 1
+                        results[pdf_path] = count
         
-        total_formulas = sum(len(eqs) for eqs in results.values())
+        total_formulas = sum(results.values())
         print(f"[FormulaExtractor] 批量提取完成: {len(results)} 个PDF, 共 {total_formulas} 个公式")
+        print(f"[FormulaExtractor] 公式索引已写入: {jsonl_path}")
         
         return results
 
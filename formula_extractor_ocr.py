@@ -4,13 +4,53 @@ PDF公式提取器 (改进版v2 - 基于编号查找)
 """
 import fitz  # PyMuPDF
 from typing import List, Dict, Optional, Tuple
+import functools
 import os
 import re
 
+# Pillow 用于OCR前加载/缩放公式图片 (Pix2Text 本身依赖 Pillow, 模型则在首次OCR时延迟加载)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# 快速探测页面中是否存在公式编号 (3.114) / [1], 用于跳过无公式页面
+_RE_EQNUM_PROBE = re.compile(r'\(\d+(?:\.\d+)?\)|\[\d+(?:\.\d+)?\]')
+
+
+@functools.lru_cache(maxsize=4096)
+def _has_math_features_text(text: str) -> bool:
+    """检查文本是否包含数学特征 (放宽条件)"""
+    if not text or len(text) < 2:
+        return False
+    
+    # 排除参考文献
+    if re.match(r'^\s*\d+\.\s+[A-Z]', text):
+        return False
+    
+    if any(kw in text for kw in ['IEEE', 'J.', 'Circuits', 'Trans.', 'Proc.', 'pp.', 'vol.']):
+        return False
+    
+    # 数学特征 (放宽)
+    math_symbols = ['≈', '×', '÷', '/', '=', '∫', '∑', '±', '→']
+    has_symbol = any(s in text for s in math_symbols)
+    
+    # 下标 (如 R_S1, C_L)
+    has_subscript = bool(re.search(r'[A-Z][A-Z_]*\s*[₀₁₂₃₄₅₆₇₈₉]|[A-Z]\s*S\d|[A-Z]_[A-Z0-9]', text))
+    
+    # 变量模式 (如 "resistors R S1, R S2")
+    has_variables = bool(re.search(r'\b[A-Z]\s+[A-Z]?\d+\b', text))
+    
+    return has_symbol or has_subscript or has_variables
+
 
 class FormulaExtractorOCR:
     """PDF公式提取器 - 使用OCR识别公式"""
     
+    # 每次提交给Pix2Text的图片数量
+    OCR_BATCH_SIZE = 16
+    
     def __init__(self, output_dir: str = "./data_base_v3/formulas"):
         """
         初始化公式提取器
@@ -21,14 +61,18 @@ class FormulaExtractorOCR:
         self.output_dir = output_dir
         os.makedirs(output_dir, exist_ok=True)
         
-        # 初始化Pix2Text
+        # Pix2Text模型较大, 延迟到首次需要OCR时再加载
         self.p2t = None
-        self._init_pix2text()
+        self._p2t_loaded = False
         
         # 初始化缓存
         self.cache_file = os.path.join(output_dir, "ocr_cache.json")
         self.ocr_cache = {}
         self._load_cache()
+        # 是否写回缓存文件: 并行提取的子进程中关闭, 新条目交给主进程合并后统一保存
+        self.persist_cache = True
+        # 上次 take_new_cache_entries 之后新识别的条目
+        self._new_cache_entries = {}
         
         print(f"[FormulaExtractorOCR] 初始化完成, 输出目录: {output_dir}")
         print(f"[FormulaExtractorOCR] 加载缓存: {len(self.ocr_cache)} 条记录")
@@ -45,16 +89,43 @@ class FormulaExtractorOCR:
                 self.ocr_cache = {}
 
     def _save_cache(self):
-        """保存OCR缓存"""
+        """保存OCR缓存 (先写临时文件再原子替换, 写入中断不会损坏已有缓存)"""
+        if not self.persist_cache:
+            return
+        tmp_path = self.cache_file + '.tmp'
         try:
             import json
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
                 json.dump(self.ocr_cache, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.cache_file)
         except Exception as e:
             print(f"[FormulaExtractorOCR] 保存缓存失败: {e}")
     
+    def take_new_cache_entries(self) -> Dict[str, str]:
+        """取出上次调用以来新识别的缓存条目 (子进程将其返回给主进程)"""
+        entries, self._new_cache_entries = self._new_cache_entries, {}
+        return entries
+    
+    def merge_cache(self, entries: Dict[str, str]):
+        """合并子进程识别的缓存条目并保存"""
+        if not entries:
+            return
+        self.ocr_cache.update(entries)
+        self._save_cache()
+    
+    def _ensure_pix2text(self) -> bool:
+        """按需加载Pix2Text (只尝试一次), 返回是否可用"""
+        if not self._p2t_loaded:
+            self._p2t_loaded = True
+            self._init_pix2text()
+        return self.p2t is not None
+    
     def _init_pix2text(self):
         """初始化Pix2Text"""
+        if Image is None:
+            print("[FormulaExtractorOCR] ⚠ Pillow未安装,将使用基础文本提取")
+            self.p2t = None
+            return
         try:
             from pix2text import Pix2Text
             print("[FormulaExtractorOCR] 加载Pix2Text模型...")
@@ -76,7 +147,7 @@ class FormulaExtractorOCR:
         1. 查找所有公式编号块 (X.Y)
         2. 向左查找相邻的数学表达式块
         3. 合并公式内容和编号
-        4. OCR识别转LaTeX
+        4. OCR识别转LaTeX (整份文档渲染完成后分批识别)
         
         Args:
             pdf_path: PDF文件路径
@@ -94,7 +165,8 @@ class FormulaExtractorOCR:
             print(f"[FormulaExtractorOCR] 打开PDF失败: {pdf_path}, 错误: {e}")
             return []
         
-        formulas = []
+        # 第一遍: 检测并渲染公式区域, OCR推迟到第二遍批量执行
+        pending = []
         base_name = os.path.splitext(os.path.basename(pdf_path))[0]
         
         print(f"[FormulaExtractorOCR] 开始提取: {pdf_path} (共{len(doc)}页)")
@@ -104,15 +176,20 @@ class FormulaExtractorOCR:
             page_rect = page.rect
             page_width = page_rect.width
             
-            # 获取页面文本块
+            # 获取页面文本块 (先用纯文本探测编号, 无编号的页面跳过结构化提取)
             try:
+                if not _RE_EQNUM_PROBE.search(page.get_text()):
+                    continue
                 blocks = page.get_text("dict")["blocks"]
             except Exception as e:
                 print(f"[FormulaExtractorOCR] 获取文本块失败 (页{page_num}): {e}")
                 continue
             
+            # 每个块的文本只计算一次, 供编号查找/内容查找/上下文提取共用
+            block_texts = [None] * len(blocks)
+            
             # 策略: 查找公式编号,然后查找相邻的公式内容
-            equation_numbers = self._find_equation_numbers(blocks, page_width)
+            equation_numbers = self._find_equation_numbers(blocks, page_width, block_texts)
             
             for eq_num_info in equation_numbers:
                 eq_num = eq_num_info['number']
@@ -122,7 +199,7 @@ class FormulaExtractorOCR:
 
                 # 查找公式内容(向左查找相邻块)
                 formula_blocks = self._find_formula_content(
-                    blocks, eq_block_idx, eq_bbox, page_width
+                    blocks, eq_block_idx, eq_bbox, page_width, block_texts
                 )
                 
                 # [改进] 如果找不到文本块，尝试使用视觉回退策略 (Visual Fallback)
@@ -149,42 +226,55 @@ class FormulaExtractorOCR:
                 if not image_path:
                     continue
                 
-                # OCR识别
-                if self.p2t:
-                    latex = self._ocr_formula(image_path)
-                else:
-                    latex = ""
-                
-                # 如果是回退模式且OCR结果太短，可能抓取了空白，丢弃
-                if using_fallback and len(latex) < 3:
-                     # print(f"[FormulaExtractorOCR] 丢弃无效OCR结果: {formula_id}")
-                     if os.path.exists(image_path):
-                         os.remove(image_path)
-                     continue
-
-                # 提取文本
-                if formula_blocks:
-                    text_parts = [self._extract_block_text(b) for b in formula_blocks]
-                    text = " ".join(text_parts) + f" ({eq_num})"
-                else:
-                    # 回退模式下没有提取到文本块，使用LaTeX作为文本
-                    text = f"{latex} ({eq_num})"
-                
                 # 提取上下文
-                context = self._extract_context(blocks, eq_block_idx) # Use eq block idx for context
+                context = self._extract_context(blocks, eq_block_idx, block_texts) # Use eq block idx for context
                 
-                formulas.append({
+                pending.append({
                     'formula_id': formula_id,
                     'page': page_num,
                     'bbox': list(merged_bbox),
                     'image_path': image_path,
-                    'text': text.strip(),
-                    'latex': latex,
+                    'text_parts': [b['text'] for b in formula_blocks],
+                    'eq_num': eq_num,
+                    'using_fallback': using_fallback,
                     'context': context,
-                    'source': pdf_path
                 })
         
         doc.close()
+        
+        # 第二遍: 批量OCR识别
+        latex_map = self._ocr_formulas([item['image_path'] for item in pending])
+        
+        formulas = []
+        for item in pending:
+            image_path = item['image_path']
+            latex = latex_map.get(image_path, "")
+            
+            # 如果是回退模式且OCR结果太短，可能抓取了空白，丢弃
+            if item['using_fallback'] and len(latex) < 3:
+                 # print(f"[FormulaExtractorOCR] 丢弃无效OCR结果: {item['formula_id']}")
+                 if os.path.exists(image_path):
+                     os.remove(image_path)
+                 continue
+
+            # 提取文本
+            if item['text_parts']:
+                text = " ".join(item['text_parts']) + f" ({item['eq_num']})"
+            else:
+                # 回退模式下没有提取到文本块，使用LaTeX作为文本
+                text = f"{latex} ({item['eq_num']})"
+            
+            formulas.append({
+                'formula_id': item['formula_id'],
+                'page': item['page'],
+                'bbox': item['bbox'],
+                'image_path': image_path,
+                'text': text.strip(),
+                'latex': latex,
+                'context': item['context'],
+                'source': pdf_path
+            })
+        
         self._save_cache() # 保存缓存
         print(f"[FormulaExtractorOCR] 提取完成: {len(formulas)} 个公式")
         return formulas
@@ -226,11 +316,17 @@ class FormulaExtractorOCR:
     def _find_equation_numbers(
         self, 
         blocks: List[Dict], 
-        page_width: float
+        page_width: float,
+        block_texts: Optional[List[Optional[str]]] = None
     ) -> List[Dict]:
         """
         查找所有公式编号块
         
+        Args:
+            blocks: 页面文本块
+            page_width: 页面宽度
+            block_texts: 可选, 块文本缓存(与blocks等长)
+        
         Returns:
             [{'number': '3.114', 'block_idx': 16, 'bbox': [...]}]
         """
@@ -240,7 +336,7 @@ class FormulaExtractorOCR:
             if block.get("type") != 0:
                 continue
             
-            text = self._extract_block_text(block)
+            text = self._get_block_text(blocks, idx, block_texts)
             bbox = block.get("bbox")
             
             if not text or not bbox:
@@ -275,7 +371,8 @@ class FormulaExtractorOCR:
         blocks: List[Dict],
         eq_block_idx: int,
         eq_bbox: tuple,
-        page_width: float
+        page_width: float,
+        block_texts: Optional[List[Optional[str]]] = None
     ) -> List[Dict]:
         """
         查找公式编号左侧的公式内容
@@ -284,6 +381,9 @@ class FormulaExtractorOCR:
         1. 查找与编号在同一行或相邻行的块
         2. 块的x坐标在编号左侧
         3. 包含数学特征
+        
+        块按阅读顺序(近似y升序)排列, 因此从编号前一块向前回溯,
+        一旦块位于编号上方超过60即可停止
         """
         eq_y0, eq_y1 = eq_bbox[1], eq_bbox[3]
         eq_y_center = (eq_y0 + eq_y1) / 2
@@ -291,13 +391,12 @@ class FormulaExtractorOCR:
         
         formula_blocks = []
         
-        for idx, block in enumerate(blocks):
+        # 只看编号之前的块
+        for idx in range(eq_block_idx - 1, -1, -1):
+            block = blocks[idx]
             if block.get("type") != 0:
                 continue
             
-            if idx >= eq_block_idx:  # 只看编号之前的块
-                continue
-            
             bbox = block.get("bbox")
             if not bbox:
                 continue
@@ -305,16 +404,19 @@ class FormulaExtractorOCR:
             x0, y0, x1, y1 = bbox
             y_center = (y0 + y1) / 2
             
+            # 已回溯到编号上方较远处, 更早的块不再可能相邻
+            if y_center < eq_y_center - 60:
+                break
+            
             # 检查是否在同一行或相邻行 (放宽条件: y中心距离 < 60)
-            y_distance = abs(y_center - eq_y_center)
-            if y_distance > 60:
+            if y_center > eq_y_center + 60:
                 continue
             
             # 检查是否在编号左侧或略微重叠
             if x0 >= eq_x0:
                 continue
             
-            text = self._extract_block_text(block)
+            text = self._get_block_text(blocks, idx, block_texts)
             
             # 检查数学特征
             if self._has_math_features(text):
@@ -325,34 +427,15 @@ class FormulaExtractorOCR:
                     'block': block
                 })
         
-        # 按x坐标排序(从左到右)
+        # 恢复阅读顺序后按x坐标排序(从左到右)
+        formula_blocks.reverse()
         formula_blocks.sort(key=lambda b: b['bbox'][0])
         
         return formula_blocks
     
     def _has_math_features(self, text: str) -> bool:
-        """检查文本是否包含数学特征 (放宽条件)"""
-        if not text or len(text) < 2:
-            return False
-        
-        # 排除参考文献
-        if re.match(r'^\s*\d+\.\s+[A-Z]', text):
-            return False
-        
-        if any(kw in text for kw in ['IEEE', 'J.', 'Circuits', 'Trans.', 'Proc.', 'pp.', 'vol.']):
-            return False
-        
-        # 数学特征 (放宽)
-        math_symbols = ['≈', '×', '÷', '/', '=', '∫', '∑', '±', '→']
-        has_symbol = any(s in text for s in math_symbols)
-        
-        # 下标 (如 R_S1, C_L)
-        has_subscript = bool(re.search(r'[A-Z][A-Z_]*\s*[₀₁₂₃₄₅₆₇₈₉]|[A-Z]\s*S\d|[A-Z]_[A-Z0-9]', text))
-        
-        # 变量模式 (如 "resistors R S1, R S2")
-        has_variables = bool(re.search(r'\b[A-Z]\s+[A-Z]?\d+\b', text))
-        
-        return has_symbol or has_subscript or has_variables
+        """检查文本是否包含数学特征 (结果按文本缓存, 见 _has_math_features_text)"""
+        return _has_math_features_text(text)
     
     def _merge_bboxes(self, bboxes: List[tuple]) -> tuple:
         """合并多个bbox"""
@@ -374,6 +457,22 @@ class FormulaExtractorOCR:
                 text += span.get("text", "") + " "
         return text.strip()
     
+    def _get_block_text(
+        self,
+        blocks: List[Dict],
+        idx: int,
+        block_texts: Optional[List[Optional[str]]] = None
+    ) -> str:
+        """获取第idx个块的文本 (如提供block_texts则按块缓存)"""
+        if block_texts is None:
+            return self._extract_block_text(blocks[idx])
+        
+        text = block_texts[idx]
+        if text is None:
+            text = self._extract_block_text(blocks[idx])
+            block_texts[idx] = text
+        return text
+    
     def _render_formula_region(
         self, 
         page, 
@@ -383,17 +482,13 @@ class FormulaExtractorOCR:
         """渲染公式区域为高清图像"""
         try:
             # 扩展边界框
-            x0, y0, x1, y1 = bbox
-            width = x1 - x0
-            height = y1 - y0
+            rect = fitz.Rect(bbox)
             margin = 0.15
+            dx = rect.width * margin
+            dy = rect.height * margin
             
-            clip_rect = fitz.Rect(
-                max(0, x0 - width * margin),
-                max(0, y0 - height * margin),
-                x1 + width * margin,
-                y1 + height * margin
-            )
+            # 扩展后与页面区域求交, 一次完成裁剪
+            clip_rect = (rect + (-dx, -dy, dx, dy)) & page.rect
             
             # 高分辨率渲染 -> 降低分辨率以提升速度 (300dpi -> ~144dpi)
             # 2.0倍缩放，配合后续的max_dim限制
@@ -406,71 +501,122 @@ class FormulaExtractorOCR:
             
             return image_path
             
-            return image_path
-            
         except Exception as e:
             print(f"[FormulaExtractorOCR] 渲染公式失败 ({formula_id}): {e}")
             return None
     
     def _ocr_formula(self, image_path: str) -> str:
-        """使用Pix2Text OCR识别公式 (带缓存 + 图像缩放优化)"""
-        if not self.p2t:
-            return ""
+        """使用Pix2Text OCR识别单个公式 (带缓存 + 图像缩放优化)"""
+        return self._ocr_formulas([image_path]).get(image_path, "")
+    
+    def _ocr_formulas(self, image_paths: List[str]) -> Dict[str, str]:
+        """
+        使用Pix2Text批量OCR识别公式
         
-        filename = os.path.basename(image_path)
-        if filename in self.ocr_cache:
-            return self.ocr_cache[filename]
+        已缓存的图片直接返回, 其余图片按OCR_BATCH_SIZE分批提交,
+        以摊薄每次模型调用的固定开销
         
-        try:
-            # 性能优化: 如果图片过大，先缩小
-            # Pix2Text在处理大图时极其缓慢(尤其是CPU模式)
-            from PIL import Image
-            
-            with Image.open(image_path) as img:
-                w, h = img.size
-                max_dim = 800 # 限制最大边长为800px (对于公式识别通常足够)
-                
-                if w > max_dim or h > max_dim:
-                    scale = max_dim / max(w, h)
-                    new_w = int(w * scale)
-                    new_h = int(h * scale)
-                    # print(f"[FormulaExtractorOCR] 缩放过大图片: {w}x{h} -> {new_w}x{new_h}")
-                    img_resized = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                    result = self.p2t.recognize_formula(img_resized)
-                else:
-                    result = self.p2t.recognize_formula(img)
+        Args:
+            image_paths: 公式图片路径列表
             
-            if isinstance(result, dict):
-                latex = result.get('text', result.get('latex', ''))
+        Returns:
+            {image_path: latex}
+        """
+        results = {}
+        misses = []
+        for image_path in image_paths:
+            filename = os.path.basename(image_path)
+            if filename in self.ocr_cache:
+                results[image_path] = self.ocr_cache[filename]
             else:
-                latex = str(result)
+                misses.append(image_path)
+        
+        # 全部命中缓存时无需加载模型
+        if not misses or not self._ensure_pix2text():
+            return results
+        
+        for i in range(0, len(misses), self.OCR_BATCH_SIZE):
+            batch_paths = misses[i:i + self.OCR_BATCH_SIZE]
             
-            clean_latex = latex.strip()
-            # 更新缓存
-            self.ocr_cache[filename] = clean_latex
-            return clean_latex
+            batch_paths_ok = []
+            images = []
+            for image_path in batch_paths:
+                try:
+                    images.append(self._load_ocr_image(image_path))
+                    batch_paths_ok.append(image_path)
+                except Exception as e:
+                    print(f"[FormulaExtractorOCR] OCR识别失败 ({os.path.basename(image_path)}): {e}")
+                    results[image_path] = ""
             
-        except Exception as e:
-            print(f"[FormulaExtractorOCR] OCR识别失败 ({os.path.basename(image_path)}): {e}")
-            return ""
+            if not images:
+                continue
+            
+            try:
+                batch_results = self.p2t.recognize_formula(images, batch_size=len(images))
+                if not isinstance(batch_results, list) or len(batch_results) != len(images):
+                    raise ValueError("批量识别结果数量不匹配")
+            except Exception as e:
+                # 旧版本Pix2Text不支持列表输入, 回退到逐张识别
+                print(f"[FormulaExtractorOCR] 批量OCR失败, 回退逐张识别: {e}")
+                batch_results = []
+                for image_path, img in zip(batch_paths_ok, images):
+                    try:
+                        batch_results.append(self.p2t.recognize_formula(img))
+                    except Exception as e:
+                        print(f"[FormulaExtractorOCR] OCR识别失败 ({os.path.basename(image_path)}): {e}")
+                        batch_results.append("")
+            
+            for image_path, result in zip(batch_paths_ok, batch_results):
+                if isinstance(result, dict):
+                    latex = result.get('text', result.get('latex', ''))
+                else:
+                    latex = str(result)
+                
+                clean_latex = latex.strip()
+                # 更新缓存
+                filename = os.path.basename(image_path)
+                self.ocr_cache[filename] = clean_latex
+                self._new_cache_entries[filename] = clean_latex
+                results[image_path] = clean_latex
+        
+        return results
     
-    def _extract_context(self, blocks: List[Dict], current_idx: int) -> str:
+    def _load_ocr_image(self, image_path: str):
+        """加载公式图片, 过大时先缩小"""
+        # 性能优化: 如果图片过大，先缩小
+        # Pix2Text在处理大图时极其缓慢(尤其是CPU模式)
+        with Image.open(image_path) as img:
+            w, h = img.size
+            max_dim = 800 # 限制最大边长为800px (对于公式识别通常足够)
+            
+            if w > max_dim or h > max_dim:
+                scale = max_dim / max(w, h)
+                new_w = int(w * scale)
+                new_h = int(h * scale)
+                # print(f"[FormulaExtractorOCR] 缩放过大图片: {w}x{h} -> {new_w}x{new_h}")
+                return img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+            
+            img.load()
+            return img.copy()
+    
+    def _extract_context(
+        self,
+        blocks: List[Dict],
+        current_idx: int,
+        block_texts: Optional[List[Optional[str]]] = None
+    ) -> str:
         """提取公式的上下文"""
         if current_idx > 0:
             prev_block = blocks[current_idx - 1]
             if prev_block.get("type") == 0:
-                text = self._extract_block_text(prev_block)
-                sentences = text.split('。')
-                if sentences:
-                    return sentences[-1].strip()[:100]
+                text = self._get_block_text(blocks, current_idx - 1, block_texts)
+                return text.rsplit('。', 1)[-1].strip()[:100]
         
         if current_idx + 1 < len(blocks):
             next_block = blocks[current_idx + 1]
             if next_block.get("type") == 0:
-                text = self._extract_block_text(next_block)
-                sentences = text.split('。')
-                if sentences:
-                    return sentences[0].strip()[:100]
+                text = self._get_block_text(blocks, current_idx + 1, block_texts)
+                return text.split('。', 1)[0].strip()[:100]
         
         return ""
 
@@ -3,13 +3,22 @@ Gemini 多模态聊天模型封装 (v3)
 负责与 Gemini-2.x 系列模型进行文本/图像混合对话。
 """
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterator, List, Optional
 
 import google.generativeai as genai  # 需要用户安装 google-generativeai
 
 from config_v3 import ConfigV3
 
 
+# 按扩展名确定上传图片的 MIME 类型, 未知扩展名按 PNG 处理
+_IMAGE_MIME_TYPES = {
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+}
+
+
 class GeminiChatModel:
     """Gemini 聊天模型封装类（支持多模态输入）"""
 
@@ -51,8 +60,44 @@ class GeminiChatModel:
         """
         带图片的多模态对话:
         - prompt: 文字指令 + 上下文
-        - image_paths: 本地 PNG 图片路径列表
+        - image_paths: 本地图片路径列表 (PNG/WebP/JPEG)
+        """
+        parts = self._build_parts(prompt, image_paths)
+
+        try:
+            resp = self.model.generate_content(parts)
+            return resp.text or ""
+        except Exception as e:
+            return f"[Gemini 多模态对话出错]: {e}"
+
+    def chat_stream(
+        self,
+        prompt: str,
+        image_paths: Optional[List[str]] = None,
+    ) -> Iterator[str]:
         """
+        流式对话: 逐段返回模型输出, 首个片段到达即可显示
+        - prompt: 文字指令 + 上下文
+        - image_paths: 本地图片路径列表, 为空时为纯文本对话
+        """
+        parts = self._build_parts(prompt, image_paths) if image_paths else prompt
+
+        try:
+            for chunk in self.model.generate_content(parts, stream=True):
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # 片段不含文本(如被安全策略拦截)时跳过
+                    continue
+                if text:
+                    yield text
+        except Exception as e:
+            label = "多模态对话" if image_paths else "对话"
+            yield f"[Gemini {label}出错]: {e}"
+
+    @staticmethod
+    def _build_parts(prompt: str, image_paths: List[str]) -> List:
+        """组装多模态输入: 文本在前, 随后是可读取的图片"""
         parts: List = [prompt]
 
         for p in image_paths:
@@ -62,15 +107,11 @@ class GeminiChatModel:
                 continue
             parts.append(
                 {
-                    "mime_type": "image/png",
+                    "mime_type": _IMAGE_MIME_TYPES.get(Path(p).suffix.lower(), "image/png"),
                     "data": data,
                 }
             )
 
-        try:
-            resp = self.model.generate_content(parts)
-            return resp.text or ""
-        except Exception as e:
-            return f"[Gemini 多模态对话出错]: {e}"
+        return parts
 
 
@@ -3,15 +3,81 @@
 统一管理文本、图片、公式的索引和关联关系
 """
 import json
-from typing import List, Dict, Optional
+from array import array
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Set, Iterable, Tuple
 from langchain_core.documents import Document
 import hashlib
+import mmap
 import os
+import sys
+import time
+
+# orjson 在C层完成UTF-8编解码, 大索引的保存/加载快数倍; 未安装时回退到标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# MessagePack 二进制副本: 启动加载时比解析JSON文本更快, 未安装时只使用JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# chunk_id 只需稳定指纹, 不需要密码学强度; 优先使用更快的 xxh3
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CHUNK_HASHERS = {
+    'md5': lambda data: hashlib.md5(data).hexdigest(),
+}
+if xxhash is not None:
+    CHUNK_HASHERS['xxh3_64'] = lambda data: xxhash.xxh3_64(data).hexdigest()
+
+DEFAULT_CHUNK_HASH = 'xxh3_64' if xxhash is not None else 'md5'
+
+# 二进制副本中以整数数组存储的关联表
+LINK_SECTIONS = ('text_to_figures', 'text_to_formulas')
+
+
+def _json_bytes(obj) -> bytes:
+    """将单个对象序列化为紧凑的UTF-8 JSON"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _parse_mapped(path: str, parse):
+    """
+    以只读内存映射方式打开文件并交给 parse 解析
+    
+    解析器直接读取映射的页面, 不再额外复制一份完整的文件内容到Python bytes
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return parse(b'')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                return parse(view)
+            finally:
+                view.release()
+
+
+def _trigrams(text: str) -> Set[str]:
+    """返回文本的所有三字符子串"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
 
 
 class MultimodalIndex:
     """多模态内容索引"""
     
+    # 有未保存修改时, 距上次保存超过该秒数则由 maybe_save 自动落盘
+    AUTOSAVE_INTERVAL = 30.0
+    
     def __init__(self, index_path: str = "./data_base_v3/multimodal_index.json"):
         """
         初始化多模态索引
@@ -20,6 +86,9 @@ class MultimodalIndex:
             index_path: 索引文件路径
         """
         self.index_path = index_path
+        # JSON为主格式(调试脚本直接读取), .msgpack为加载用的二进制副本
+        self.binary_path = os.path.splitext(index_path)[0] + ".msgpack"
+        self._chunk_hasher = CHUNK_HASHERS[DEFAULT_CHUNK_HASH]
         self.index = {
             'figures': {},  # figure_id -> metadata
             'formulas': {},  # formula_id -> metadata
@@ -27,12 +96,26 @@ class MultimodalIndex:
             'text_to_formulas': {},  # chunk_id -> [formula_ids]
             'metadata': {
                 'version': '1.0',
+                'chunk_hash': DEFAULT_CHUNK_HASH,
                 'total_figures': 0,
                 'total_formulas': 0,
                 'total_links': 0
             }
         }
         
+        # 派生查找表(不持久化, 首次查询时按需构建)
+        self._lookup_ready = False
+        
+        # 关联条数计数器(随关联增量维护, 加载/清空时重新统计)
+        self._fig_link_count = 0
+        self._formula_link_count = 0
+        
+        # 未保存修改标记, 由 maybe_save 按时间间隔批量落盘
+        self._dirty = False
+        self._last_save = time.monotonic()
+        # batch() 嵌套层数, 大于0时暂停自动保存
+        self._batch_depth = 0
+        
         # 确保目录存在
         os.makedirs(os.path.dirname(index_path), exist_ok=True)
         
@@ -52,8 +135,15 @@ class MultimodalIndex:
             figure_meta: 图片元数据字典
         """
         fig_id = figure_meta['figure_id']
+        if self._lookup_ready:
+            old_meta = self.index['figures'].get(fig_id)
+            if old_meta is not None:
+                self._unindex_figure(fig_id, old_meta)
+            self._index_figure(fig_id, figure_meta)
         self.index['figures'][fig_id] = figure_meta
         self.index['metadata']['total_figures'] = len(self.index['figures'])
+        self._dirty = True
+        self.maybe_save()
     
     def add_formula(self, formula_meta: Dict):
         """
@@ -63,8 +153,15 @@ class MultimodalIndex:
             formula_meta: 公式元数据字典
         """
         eq_id = formula_meta['formula_id']
+        if self._lookup_ready:
+            old_meta = self.index['formulas'].get(eq_id)
+            if old_meta is not None:
+                self._unindex_formula(eq_id, old_meta)
+            self._index_formula(eq_id, formula_meta)
         self.index['formulas'][eq_id] = formula_meta
         self.index['metadata']['total_formulas'] = len(self.index['formulas'])
+        self._dirty = True
+        self.maybe_save()
     
     def link_text_to_figure(self, chunk_id: str, figure_id: str):
         """
@@ -80,7 +177,10 @@ class MultimodalIndex:
         # 避免重复关联
         if figure_id not in self.index['text_to_figures'][chunk_id]:
             self.index['text_to_figures'][chunk_id].append(figure_id)
+            self._fig_link_count += 1
             self._update_link_count()
+            self._dirty = True
+            self.maybe_save()
     
     def link_text_to_formula(self, chunk_id: str, formula_id: str):
         """
@@ -96,7 +196,10 @@ class MultimodalIndex:
         # 避免重复关联
         if formula_id not in self.index['text_to_formulas'][chunk_id]:
             self.index['text_to_formulas'][chunk_id].append(formula_id)
+            self._formula_link_count += 1
             self._update_link_count()
+            self._dirty = True
+            self.maybe_save()
     
     def get_related_figures(self, doc: Document) -> List[Dict]:
         """
@@ -159,16 +262,21 @@ class MultimodalIndex:
         Returns:
             匹配的图片元数据列表
         """
+        self._ensure_lookup()
         results = []
         keyword_lower = keyword.lower()
+        figures = self.index['figures']
         
-        for fig_id, fig in self.index['figures'].items():
-            caption = fig.get('caption', '')
-            source = fig.get('source', '')
-            
-            if keyword_lower in caption.lower():
-                if source_filter is None or source_filter.lower() in source.lower():
-                    results.append(fig)
+        candidates = self._lookup_candidates(
+            self._caption_grams, keyword_lower, self._fig_order, figures.keys()
+        )
+        captions_lower = self._fig_caption_lower
+        sources_lower = self._fig_source_lower
+        filter_lower = source_filter.lower() if source_filter is not None else None
+        for fig_id in candidates:
+            if keyword_lower in captions_lower[fig_id]:
+                if filter_lower is None or filter_lower in sources_lower[fig_id]:
+                    results.append(figures[fig_id])
                     
         return results
     
@@ -183,17 +291,22 @@ class MultimodalIndex:
         Returns:
             该页面的图片列表
         """
-        results = []
-        source_lower = source.lower()
+        self._ensure_lookup()
+        figures = self.index['figures']
         
-        for fig_id, fig in self.index['figures'].items():
-            fig_source = fig.get('source', '')
-            fig_page = fig.get('page', -1)
-            
-            if fig_page == page and source_lower in fig_source.lower():
-                results.append(fig)
+        # 检索时同一 (文档, 页码) 会被反复查询, 匹配结果按键缓存
+        key = (source.lower(), page)
+        fig_ids = self._page_query_memo.get(key)
+        if fig_ids is None:
+            source_lower = key[0]
+            sources_lower = self._fig_source_lower
+            fig_ids = [
+                fig_id for fig_id in self._figs_by_page.get(page, [])
+                if source_lower in sources_lower[fig_id]
+            ]
+            self._page_query_memo[key] = fig_ids
                 
-        return results
+        return [figures[fig_id] for fig_id in fig_ids]
     
     def search_formulas_by_id(self, formula_num: str, source_filter: str = None) -> List[Dict]:
         """
@@ -206,25 +319,130 @@ class MultimodalIndex:
         Returns:
             匹配的公式列表
         """
+        self._ensure_lookup()
         results = []
+        formulas = self.index['formulas']
         
-        for eq_id, eq in self.index['formulas'].items():
+        candidates = self._lookup_candidates(
+            self._formula_grams, formula_num, self._formula_order, formulas.keys()
+        )
+        sources_lower = self._formula_source_lower
+        filter_lower = source_filter.lower() if source_filter is not None else None
+        for eq_id in candidates:
+            eq = formulas[eq_id]
             eq_text = eq.get('text', '')
             eq_context = eq.get('context', '')
-            source = eq.get('source', '')
             
             # 检查编号是否在 text 或 context 中
             if formula_num in eq_text or formula_num in eq_context:
-                if source_filter is None or source_filter.lower() in source.lower():
+                if filter_lower is None or filter_lower in sources_lower[eq_id]:
                     results.append(eq)
                     
         return results
     
+    def _ensure_lookup(self):
+        """首次查询前构建派生查找表, 之后由 add_figure/add_formula 增量维护"""
+        if not self._lookup_ready:
+            self._rebuild_lookup()
+    
+    def _rebuild_lookup(self):
+        """
+        根据 figures/formulas 重建派生查找表
+        
+        - _figs_by_page: page -> [figure_id]
+        - _caption_grams / _formula_grams: 三字符子串 -> {id} 倒排表,
+          用于缩小子串搜索的候选集 (候选仍按原条件校验, 结果与全表扫描一致)
+        - _fig_order / _formula_order: id -> 插入序号, 保证结果顺序与全表扫描一致
+        - _fig_caption_lower / _fig_source_lower / _formula_source_lower:
+          id -> 预先小写化的 caption/source, 查询时不再逐条 lower()
+        - _page_query_memo: (source小写, page) -> get_figures_by_page 的匹配结果,
+          图片增删时清空
+        """
+        self._figs_by_page: Dict[int, List[str]] = {}
+        self._caption_grams: Dict[str, Set[str]] = {}
+        self._formula_grams: Dict[str, Set[str]] = {}
+        self._fig_order: Dict[str, int] = {}
+        self._formula_order: Dict[str, int] = {}
+        self._fig_caption_lower: Dict[str, str] = {}
+        self._fig_source_lower: Dict[str, str] = {}
+        self._formula_source_lower: Dict[str, str] = {}
+        self._page_query_memo: Dict[Tuple[str, int], List[str]] = {}
+        
+        for fig_id, fig in self.index['figures'].items():
+            self._index_figure(fig_id, fig)
+        for eq_id, eq in self.index['formulas'].items():
+            self._index_formula(eq_id, eq)
+        self._lookup_ready = True
+    
+    def _index_figure(self, fig_id: str, fig: Dict):
+        """将图片加入派生查找表"""
+        self._page_query_memo.clear()
+        order = self._fig_order.setdefault(fig_id, len(self._fig_order))
+        page_ids = self._figs_by_page.setdefault(fig.get('page', -1), [])
+        page_ids.append(fig_id)
+        # 覆盖写入的旧ID保持原有位置
+        if len(page_ids) > 1 and self._fig_order[page_ids[-2]] > order:
+            page_ids.sort(key=self._fig_order.__getitem__)
+        caption_lower = fig.get('caption', '').lower()
+        self._fig_caption_lower[fig_id] = caption_lower
+        self._fig_source_lower[fig_id] = sys.intern(fig.get('source', '').lower())
+        for gram in _trigrams(caption_lower):
+            self._caption_grams.setdefault(gram, set()).add(fig_id)
+    
+    def _unindex_figure(self, fig_id: str, fig: Dict):
+        """从派生查找表中移除图片(覆盖写入前调用)"""
+        self._page_query_memo.clear()
+        page_ids = self._figs_by_page.get(fig.get('page', -1))
+        if page_ids and fig_id in page_ids:
+            page_ids.remove(fig_id)
+        for gram in _trigrams(fig.get('caption', '').lower()):
+            self._caption_grams.get(gram, set()).discard(fig_id)
+    
+    def _index_formula(self, eq_id: str, eq: Dict):
+        """将公式加入派生查找表"""
+        self._formula_order.setdefault(eq_id, len(self._formula_order))
+        self._formula_source_lower[eq_id] = sys.intern(eq.get('source', '').lower())
+        grams = _trigrams(eq.get('text', '')) | _trigrams(eq.get('context', ''))
+        for gram in grams:
+            self._formula_grams.setdefault(gram, set()).add(eq_id)
+    
+    def _unindex_formula(self, eq_id: str, eq: Dict):
+        """从派生查找表中移除公式(覆盖写入前调用)"""
+        grams = _trigrams(eq.get('text', '')) | _trigrams(eq.get('context', ''))
+        for gram in grams:
+            self._formula_grams.get(gram, set()).discard(eq_id)
+    
+    def _lookup_candidates(
+        self,
+        grams_index: Dict[str, Set[str]],
+        needle: str,
+        order: Dict[str, int],
+        all_ids: Iterable[str]
+    ) -> Iterable[str]:
+        """
+        通过三字符倒排表求可能包含 needle 的候选ID (按插入顺序)
+        
+        needle 不足3个字符时无法使用倒排表, 返回全部ID
+        """
+        grams = _trigrams(needle)
+        if not grams:
+            return all_ids
+        
+        postings = sorted((grams_index.get(g, set()) for g in grams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+        
+        return sorted(candidates, key=order.__getitem__)
+    
     def _get_chunk_id(self, doc: Document) -> str:
         """
         生成文本块唯一ID
         
         基于source、page和内容哈希生成稳定的ID
+        (哈希算法由索引元数据 chunk_hash 决定, 见 _resolve_chunk_hasher)
         
         Args:
             doc: LangChain文档对象
@@ -232,12 +450,19 @@ class MultimodalIndex:
         Returns:
             chunk_id字符串
         """
-        meta = doc.metadata or {}
+        # 同一文档块常被连续查询图片和公式, 首次计算后缓存在metadata上避免重复哈希
+        meta = doc.metadata
+        if meta is None:
+            meta = doc.metadata = {}
+        cached_id = meta.get('_chunk_id')
+        if cached_id:
+            return cached_id
+        
         source = meta.get('source', 'unknown')
         page = meta.get('page', 0)
         
         # 使用内容哈希作为ID的一部分,确保唯一性
-        content_hash = hashlib.md5(doc.page_content.encode('utf-8')).hexdigest()[:8]
+        content_hash = self._chunk_hasher(doc.page_content.encode('utf-8'))[:8]
         
         # 提取文件名(不含路径)
         if source != 'unknown':
@@ -245,21 +470,190 @@ class MultimodalIndex:
         else:
             source_name = source
         
-        return f"{source_name}_p{page}_{content_hash}"
+        chunk_id = f"{source_name}_p{page}_{content_hash}"
+        meta['_chunk_id'] = chunk_id
+        return chunk_id
+    
+    def _resolve_chunk_hasher(self):
+        """
+        根据索引元数据选择chunk_id哈希算法
+        
+        旧索引没有记录 chunk_hash 字段, 其ID均由md5生成, 继续沿用md5以保持关联可用;
+        全量重建(clear)后切换为当前最快的可用算法
+        """
+        algo = self.index['metadata'].setdefault('chunk_hash', 'md5')
+        if algo not in CHUNK_HASHERS:
+            print(f"[MultimodalIndex] ⚠ 索引使用的哈希算法 {algo} 不可用, 请安装对应依赖或全量重建")
+            algo = 'md5'
+        self._chunk_hasher = CHUNK_HASHERS[algo]
+    
+    def _recount_links(self):
+        """根据当前索引重新统计关联条数"""
+        self._fig_link_count = sum(len(figs) for figs in self.index['text_to_figures'].values())
+        self._formula_link_count = sum(len(eqs) for eqs in self.index['text_to_formulas'].values())
     
     def _update_link_count(self):
         """更新关联计数"""
         total = len(self.index['text_to_figures']) + len(self.index['text_to_formulas'])
         self.index['metadata']['total_links'] = total
     
+    def maybe_save(self, force: bool = False) -> bool:
+        """
+        有未保存修改且距上次保存超过 AUTOSAVE_INTERVAL 秒时保存索引
+        
+        Args:
+            force: 为True时只要有未保存修改就立即保存
+            
+        Returns:
+            是否执行了保存
+        """
+        if not self._dirty or self._batch_depth:
+            return False
+        if not force and time.monotonic() - self._last_save < self.AUTOSAVE_INTERVAL:
+            return False
+        self.save()
+        return True
+    
+    @contextmanager
+    def batch(self):
+        """
+        批量修改期间暂停自动保存 (可嵌套)
+        
+        重建时索引先清空再逐步填充, 中途自动保存会用不完整的索引替换磁盘上的旧索引;
+        批量修改完成后由调用方显式 save(), 中途失败时磁盘上仍是旧索引
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+    
     def save(self):
-        """保存索引到文件"""
+        """
+        保存索引到文件
+        
+        先写入临时文件再原子替换, 写入过程中崩溃不会损坏已有索引
+        """
+        tmp_path = self.index_path + '.tmp'
         try:
-            with open(self.index_path, 'w', encoding='utf-8') as f:
-                json.dump(self.index, f, ensure_ascii=False, indent=2)
+            with open(tmp_path, 'wb') as f:
+                self._stream_save(f)
+            os.replace(tmp_path, self.index_path)
             print(f"[MultimodalIndex] 索引已保存: {self.index_path}")
         except Exception as e:
             print(f"[MultimodalIndex] 保存索引失败: {e}")
+            return
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        
+        self._save_binary()
+        self._dirty = False
+        self._last_save = time.monotonic()
+    
+    def _save_binary(self):
+        """
+        写出MessagePack二进制副本 (同样逐条写出)
+        
+        关联表中的图片/公式ID以整数下标的 array('I') 字节串存储,
+        ID字符串只在 _link_ids 表中出现一次 (见 _unpack_links)
+        """
+        if msgpack is None:
+            return
+        
+        tmp_path = self.binary_path + '.tmp'
+        try:
+            packer = msgpack.Packer(use_bin_type=True)
+            link_ids = {section: {} for section in LINK_SECTIONS}
+            with open(tmp_path, 'wb') as f:
+                f.write(packer.pack_map_header(len(self.index) + 1))
+                for section, value in self.index.items():
+                    f.write(packer.pack(section))
+                    if not isinstance(value, dict) or section == 'metadata':
+                        f.write(packer.pack(value))
+                        continue
+                    
+                    id_to_idx = link_ids.get(section)
+                    f.write(packer.pack_map_header(len(value)))
+                    for key, item in value.items():
+                        f.write(packer.pack(key))
+                        if id_to_idx is not None:
+                            item = array('I', [
+                                id_to_idx.setdefault(item_id, len(id_to_idx)) for item_id in item
+                            ]).tobytes()
+                        f.write(packer.pack(item))
+                
+                # 下标 -> ID 表 (dict保持插入顺序, 即下标顺序)
+                f.write(packer.pack('_link_ids'))
+                f.write(packer.pack({section: list(ids) for section, ids in link_ids.items()}))
+            os.replace(tmp_path, self.binary_path)
+        except Exception as e:
+            print(f"[MultimodalIndex] 保存二进制索引失败: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def _intern_index(self):
+        """
+        驻留重复出现的字符串 (文档路径、关联表中的图片/公式ID)
+        
+        解析后每个值都是独立的字符串对象, 驻留后相同内容共享同一对象, 减少内存占用
+        """
+        for section in ('figures', 'formulas'):
+            for meta in self.index[section].values():
+                source = meta.get('source')
+                if isinstance(source, str):
+                    meta['source'] = sys.intern(source)
+        
+        for section in LINK_SECTIONS:
+            self.index[section] = {
+                sys.intern(chunk_id): [sys.intern(item_id) for item_id in item_ids]
+                for chunk_id, item_ids in self.index[section].items()
+            }
+    
+    @staticmethod
+    def _unpack_links(loaded_index: Dict):
+        """将二进制副本中的整数下标关联表还原为ID列表 (同一ID共享同一字符串对象)"""
+        link_ids = loaded_index.pop('_link_ids', None)
+        if link_ids is None:
+            return
+        for section in LINK_SECTIONS:
+            ids = link_ids[section]
+            loaded_index[section] = {
+                chunk_id: [ids[i] for i in array('I', packed)]
+                for chunk_id, packed in loaded_index[section].items()
+            }
+    
+    def _binary_is_fresh(self) -> bool:
+        """二进制副本存在且不旧于JSON时才使用, 避免读到过期数据"""
+        return (
+            msgpack is not None
+            and os.path.exists(self.binary_path)
+            and os.path.getmtime(self.binary_path) >= os.path.getmtime(self.index_path)
+        )
+    
+    def _stream_save(self, f):
+        """
+        逐条写出索引, 避免一次性生成整个序列化字符串
+        
+        每个顶层字段的字典按条目逐行写出(一行一个条目), 峰值内存约为单个条目大小
+        """
+        f.write(b'{')
+        for i, (section, value) in enumerate(self.index.items()):
+            if i:
+                f.write(b',')
+            f.write(b'\n' + _json_bytes(section) + b':')
+            
+            if not isinstance(value, dict) or section == 'metadata':
+                f.write(_json_bytes(value))
+                continue
+            
+            f.write(b'{')
+            for j, (key, item) in enumerate(value.items()):
+                if j:
+                    f.write(b',')
+                f.write(b'\n' + _json_bytes(key) + b':' + _json_bytes(item))
+            f.write(b'\n}')
+        f.write(b'\n}\n')
     
     def load(self):
         """从文件加载索引"""
@@ -268,13 +662,38 @@ class MultimodalIndex:
             return
         
         try:
-            with open(self.index_path, 'r', encoding='utf-8') as f:
-                loaded_index = json.load(f)
-                
-                # 合并加载的索引(保留默认结构)
-                self.index.update(loaded_index)
+            loaded_index = None
+            if self._binary_is_fresh():
+                try:
+                    loaded_index = _parse_mapped(
+                        self.binary_path,
+                        lambda buf: msgpack.unpackb(buf, raw=False, strict_map_key=False)
+                    )
+                    self._unpack_links(loaded_index)
+                except Exception as e:
+                    print(f"[MultimodalIndex] 二进制索引读取失败, 改用JSON: {e}")
+            
+            migrate = False
+            if loaded_index is None:
+                if orjson is not None:
+                    loaded_index = _parse_mapped(self.index_path, orjson.loads)
+                else:
+                    with open(self.index_path, 'r', encoding='utf-8') as f:
+                        loaded_index = json.load(f)
+                # 仅有JSON(或二进制副本已过期)时, 生成二进制副本供下次加载
+                migrate = msgpack is not None
+            
+            # 合并加载的索引(保留默认结构)
+            self.index.update(loaded_index)
+            self._intern_index()
+            self._resolve_chunk_hasher()
+            self._lookup_ready = False
+            self._recount_links()
                 
             print(f"[MultimodalIndex] 索引已加载: {self.index_path}")
+            
+            if migrate:
+                self._save_binary()
         except Exception as e:
             print(f"[MultimodalIndex] 加载索引失败: {e}, 使用空索引")
     
@@ -287,11 +706,19 @@ class MultimodalIndex:
             'text_to_formulas': {},
             'metadata': {
                 'version': '1.0',
+                'chunk_hash': DEFAULT_CHUNK_HASH,
                 'total_figures': 0,
                 'total_formulas': 0,
                 'total_links': 0
             }
         }
+        self._chunk_hasher = CHUNK_HASHERS[DEFAULT_CHUNK_HASH]
+        self._lookup_ready = False
+        self._fig_link_count = 0
+        self._formula_link_count = 0
+        # 清空后不立即落盘, 给重建留出一个保存间隔
+        self._dirty = True
+        self._last_save = time.monotonic()
         print("[MultimodalIndex] 索引已清空")
     
     def get_statistics(self) -> Dict:
@@ -301,8 +728,8 @@ class MultimodalIndex:
             'total_formulas': len(self.index['formulas']),
             'total_text_chunks_with_figures': len(self.index['text_to_figures']),
             'total_text_chunks_with_formulas': len(self.index['text_to_formulas']),
-            'total_figure_links': sum(len(figs) for figs in self.index['text_to_figures'].values()),
-            'total_formula_links': sum(len(eqs) for eqs in self.index['text_to_formulas'].values())
+            'total_figure_links': self._fig_link_count,
+            'total_formula_links': self._formula_link_count
         }
         return stats
     
@@ -2,7 +2,14 @@
 Embedding模型调用模块 (v3)
 负责文本向量化
 """
-from typing import List
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 from openai import OpenAI
 from config import Config
 from langchain_core.embeddings import Embeddings
@@ -11,12 +18,22 @@ from langchain_core.embeddings import Embeddings
 class QwenEmbedding(Embeddings):
     """Qwen Embedding模型封装类"""
 
-    def __init__(self, config = Config()):
+    # 单次请求的文本数量上限(Qwen embedding 接口限制)
+    BATCH_SIZE = 10
+    # 并发请求数; 请求本身是网络IO, 多批次并发可把总延迟压到接近单次RTT
+    MAX_WORKERS = 8
+
+    def __init__(
+        self,
+        config = Config(),
+        cache_path: Optional[str] = "./data_base_v3/embedding_cache.sqlite3"
+    ):
         """
         初始化Embedding模型
         
         Args:
             config: 配置对象
+            cache_path: 向量缓存文件路径(SQLite), 为None时不使用缓存
         """
         self.embedding_config = config.get_embedding_config()
 
@@ -24,6 +41,67 @@ class QwenEmbedding(Embeddings):
             api_key=self.embedding_config["api_key"],
             base_url=self.embedding_config["base_url"]
         )
+
+        # 按 (模型, 文本哈希) 缓存向量, 增量重建/重复查询时不再重复调用接口
+        self._cache: Optional[sqlite3.Connection] = None
+        self._cache_lock = threading.Lock()
+        if cache_path:
+            self._init_cache(cache_path)
+
+        # 进程内查询向量LRU (按实例, 以元组保存避免调用方修改缓存内容)
+        self._embed_query_cached = functools.lru_cache(maxsize=1024)(
+            lambda text: tuple(self.embed_documents([text])[0])
+        )
+
+    def _init_cache(self, cache_path: str):
+        """打开(或创建)向量缓存库"""
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            self._cache = sqlite3.connect(cache_path, check_same_thread=False)
+            self._cache.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, key TEXT NOT NULL, vec BLOB NOT NULL, "
+                "PRIMARY KEY (model, key))"
+            )
+            self._cache.commit()
+        except Exception as e:
+            print(f"向量缓存初始化失败, 将不使用缓存: {e}")
+            self._cache = None
+
+    @staticmethod
+    def _cache_key(text: str) -> str:
+        """文本内容哈希"""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _cache_get(self, keys: List[str]) -> Dict[str, List[float]]:
+        """批量读取缓存, 返回命中的 {key: 向量}"""
+        found: Dict[str, List[float]] = {}
+        model = self.embedding_config["model"] or ""
+        unique_keys = list(dict.fromkeys(keys))
+        with self._cache_lock:
+            # 分批查询, 避免超过SQLite参数数量上限
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i : i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._cache.execute(
+                    f"SELECT key, vec FROM embeddings WHERE model = ? AND key IN ({placeholders})",
+                    [model, *chunk],
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("d", blob).tolist()
+        return found
+
+    def _cache_put(self, items: Dict[str, List[float]]):
+        """写入缓存 (float64原样存储, 命中结果与接口返回完全一致)"""
+        model = self.embedding_config["model"] or ""
+        with self._cache_lock:
+            self._cache.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, key, vec) VALUES (?, ?, ?)",
+                [(model, key, array("d", vec).tobytes()) for key, vec in items.items()],
+            )
+            self._cache.commit()
     
     
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
@@ -40,22 +118,67 @@ class QwenEmbedding(Embeddings):
             if not isinstance(t, str):
                 raise TypeError(f"embed_documents: 第 {i} 个元素不是 str，而是 {type(t)}")
 
-        embeddings: List[List[float]] = []
+        if self._cache is None:
+            return self._embed_texts(texts)
+
+        try:
+            keys = [self._cache_key(t) for t in texts]
+            cached = self._cache_get(keys)
+        except Exception as e:
+            print(f"读取向量缓存失败: {e}")
+            return self._embed_texts(texts)
+
+        # 未命中的文本去重后统一请求
+        misses: Dict[str, str] = {}
+        for key, t in zip(keys, texts):
+            if key not in cached and key not in misses:
+                misses[key] = t
 
-        for i in range(0, len(texts), 10):
-            batch = texts[i : i + 10]
+        if misses:
+            miss_vecs = self._embed_texts(list(misses.values()))
+            new_items = dict(zip(misses.keys(), miss_vecs))
+            cached.update(new_items)
+            try:
+                self._cache_put(new_items)
+            except Exception as e:
+                print(f"写入向量缓存失败: {e}")
 
-            resp = self.client.embeddings.create(
-                model=self.embedding_config["model"],
-                input=batch,
-            )
+        return [cached[key] for key in keys]
 
-            # OpenAI v1: resp.data 是 Embedding 对象列表，每个有 .embedding
-            batch_vecs = [item.embedding for item in resp.data]
-            embeddings.extend(batch_vecs)
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """按批次调用接口获取向量(不经过缓存)"""
+        # 结果列表一次性分配, 按批次起始位置切片写入
+        embeddings: List[List[float]] = [None] * len(texts)
+
+        starts = range(0, len(texts), self.BATCH_SIZE)
+        batches = [texts[i : i + self.BATCH_SIZE] for i in starts]
+
+        if len(batches) <= 1:
+            for start, batch in zip(starts, batches):
+                embeddings[start : start + len(batch)] = self._embed_batch(batch)
+            return embeddings
+
+        # executor.map 按提交顺序返回结果, 保证向量与输入文本一一对应
+        with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(batches))) as executor:
+            for start, batch_vecs in zip(starts, executor.map(self._embed_batch, batches)):
+                embeddings[start : start + len(batch_vecs)] = batch_vecs
 
         return embeddings
 
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        """
+        调用一次 embedding 接口
+
+        429/5xx 由 OpenAI 客户端内置的指数退避重试处理 (max_retries)
+        """
+        resp = self.client.embeddings.create(
+            model=self.embedding_config["model"],
+            input=batch,
+        )
+
+        # OpenAI v1: resp.data 是 Embedding 对象列表，每个有 .embedding
+        return [item.embedding for item in resp.data]
+
     def embed_query(self, text: str) -> List[float]:
         """
         生成输入文本的 embedding.
@@ -67,7 +190,21 @@ class QwenEmbedding(Embeddings):
             embeddings (List[float]): 输入文本的 embedding，一个浮点数值列表.
         """
 
-        return self.embed_documents([text])[0]
+        return list(self._embed_query_cached(text))
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        批量生成多个查询的 embedding (重复文本只请求一次, 且合并为一次批量调用)
+
+        Args:
+            texts: 查询文本列表
+
+        Returns:
+            向量列表, 与texts顺序一致
+        """
+        unique_texts = list(dict.fromkeys(texts))
+        vec_by_text = dict(zip(unique_texts, self.embed_documents(unique_texts)))
+        return [list(vec_by_text[t]) for t in texts]
     
     
     def get_embedding_dimension(self) -> int:
@@ -98,26 +235,49 @@ class QwenEmbedding(Embeddings):
         try:
             import numpy as np
 
-            vec1 = self.embed_query(text1)
-            vec2 = self.embed_query(text2)
+            vec1, vec2 = self.embed_queries([text1, text2])
 
             if not vec1 or not vec2:
                 return 0.0
             
-            # 计算余弦相似度
-            vec1_np = np.array(vec1)
-            vec2_np = np.array(vec2)
+            # 计算余弦相似度 (float32 即可满足精度, 内存带宽减半)
+            vec1_np = np.asarray(vec1, dtype=np.float32)
+            vec2_np = np.asarray(vec2, dtype=np.float32)
             
-            similarity = np.dot(vec1_np, vec2_np) / (
-                np.linalg.norm(vec1_np) * np.linalg.norm(vec2_np)
-            )
+            norm = np.sqrt(np.dot(vec1_np, vec1_np) * np.dot(vec2_np, vec2_np))
+            if norm == 0:
+                return 0.0
             
-            return float(similarity)
+            return float(np.dot(vec1_np, vec2_np) / norm)
         
         except Exception as e:
             print(f"计算相似度失败: {e}")
             return 0.0
 
+    @staticmethod
+    def compute_similarity_batch(query_vec: List[float], vectors) -> List[float]:
+        """
+        计算一个查询向量与多个向量的余弦相似度 (单次矩阵运算)
+        
+        Args:
+            query_vec: 查询向量
+            vectors: 向量列表或 (N, dim) 矩阵
+            
+        Returns:
+            相似度列表, 与vectors顺序一致
+        """
+        import numpy as np
+
+        q = np.asarray(query_vec, dtype=np.float32)
+        mat = np.asarray(vectors, dtype=np.float32)
+        if mat.size == 0:
+            return []
+
+        norms = np.linalg.norm(mat, axis=1) * np.linalg.norm(q)
+        # 零向量的相似度记为0, 避免除零
+        norms[norms == 0] = np.inf
+        return (mat @ q / norms).tolist()
+
 
 if __name__ == "__main__":
     # 测试Embedding模块
@@ -6,6 +6,7 @@ v3 多模态 RAG 智能体
  - Gemini 2.x (flash) 作为多模态回答模型
 """
 import os
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Tuple
 
 from langchain_core.documents import Document
@@ -16,6 +17,34 @@ from .vector_store_v3 import VectorStoreV3
 from .pdf_page_images import export_pdf_pages_to_images
 from .gemini_chat_model import GeminiChatModel
 
+# 页图转存为 WebP 可使上传给 Gemini 的数据量降到 PNG 的几分之一; 未安装 Pillow 时只使用 PNG
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+WEBP_QUALITY = 85
+
+
+def _export_page_images(documents_dir: str, page_image_dir: str):
+    """导出 PDF 页图, 并为每张 PNG 生成同名 WebP 副本 (PNG 保留作为回退)"""
+    export_pdf_pages_to_images(documents_dir, page_image_dir)
+    if Image is None:
+        return
+
+    for name in os.listdir(page_image_dir):
+        if not name.lower().endswith(".png"):
+            continue
+        png_path = os.path.join(page_image_dir, name)
+        webp_path = os.path.splitext(png_path)[0] + ".webp"
+        if os.path.exists(webp_path) and os.path.getmtime(webp_path) >= os.path.getmtime(png_path):
+            continue
+        try:
+            with Image.open(png_path) as img:
+                img.save(webp_path, "WEBP", quality=WEBP_QUALITY)
+        except Exception as e:
+            print(f"[v3] 页图转换 WebP 失败 ({name}): {e}")
+
 
 class RAGAgentV3:
     """多模态 RAG 主类"""
@@ -43,6 +72,8 @@ class RAGAgentV3:
         print("[v3] Gemini 聊天模型初始化成功")
 
         # 5. PDF 页图准备（懒加载，由用户触发重建时执行）
+        #    已有页图文件名缓存为集合, 检索时直接查集合而不是逐个 stat
+        self._page_image_set = self._scan_page_images()
         print("[v3] 初始化完成, 可使用 /rebuild_v3 构建知识库+页图")
         print("=" * 60)
 
@@ -50,19 +81,34 @@ class RAGAgentV3:
     def rebuild_knowledge_base(self) -> bool:
         """重建 v3 知识库+PDF 页图"""
         print("\n[v3] 开始重建 v3 知识库...")
-        ok = self.vector_store.build_vectorstore(force_rebuild=True)
-        if not ok:
-            return False
 
-        # 导出 PDF 页图
-        export_pdf_pages_to_images(
-            self.config.documents_dir,
-            self.config.page_image_dir,
-        )
-        return True
+        # 页图仅在查询时使用, 与向量库构建互不依赖:
+        # 在子进程中导出 PDF 页图(渲染密集), 同时在主进程构建向量库(Embedding 网络IO)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            export_future = executor.submit(
+                _export_page_images,
+                self.config.documents_dir,
+                self.config.page_image_dir,
+            )
+            ok = self.vector_store.build_vectorstore(force_rebuild=True)
+
+            try:
+                export_future.result()
+            except Exception as e:
+                print(f"[v3] 导出 PDF 页图失败: {e}")
+
+        self._page_image_set = self._scan_page_images()
+        return ok
+
+    def _scan_page_images(self) -> frozenset:
+        """扫描页图目录, 返回已存在的图片文件名集合"""
+        try:
+            return frozenset(os.listdir(self.config.page_image_dir))
+        except OSError:
+            return frozenset()
 
     def _image_path_for_doc(self, doc: Document) -> str:
-        """根据文档 metadata 推导所在页的图片路径"""
+        """根据文档 metadata 推导所在页的图片路径 (优先 WebP, 没有时使用 PNG)"""
         meta = doc.metadata or {}
         source = meta.get("source") or meta.get("file_path") or meta.get("path")
         page = meta.get("page")
@@ -75,7 +121,9 @@ class RAGAgentV3:
         except Exception:
             return ""
 
-        img_name = f"{base}_page_{page_idx}.png"
+        img_name = f"{base}_page_{page_idx}.webp"
+        if img_name not in self._page_image_set:
+            img_name = f"{base}_page_{page_idx}.png"
         img_path = os.path.join(self.config.page_image_dir, img_name)
         return img_path
 
@@ -112,7 +160,11 @@ class RAGAgentV3:
 
             if len(image_paths) < max_images:
                 img_path = self._image_path_for_doc(d)
-                if img_path and os.path.exists(img_path) and img_path not in added_images:
+                if (
+                    img_path
+                    and os.path.basename(img_path) in self._page_image_set
+                    and img_path not in added_images
+                ):
                     image_paths.append(img_path)
                     added_images.add(img_path)
 
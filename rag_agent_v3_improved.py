@@ -2,11 +2,18 @@
 改进的多模态 RAG 智能体 (v3-improved)
 使用选择性提取策略,仅提取和存储PDF中的图片和公式
 """
+import functools
+import multiprocessing
 import os
+import re
 import sys
-from typing import List, Tuple, Dict
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from typing import List, Tuple, Dict, Iterator
 from pathlib import Path
 
+import numpy as np
 from langchain_core.documents import Document
 
 # 导入v3本地组件
@@ -36,9 +43,108 @@ except ImportError:
     print("[RAG] 重排序器不可用,将跳过重排序步骤")
 
 
+# 查询中的图片/公式编号 (模块级预编译, 避免每次检索重新解析)
+_FIG_RE = re.compile(r'(Figure|Fig\.?)\s*(\d+)', re.IGNORECASE)
+_FORMULA_RE = re.compile(r'(\d+\.\d+|\(\d+\)|\[\d+\])')
+
+# 两个正则都要求数字, 查询中不含数字(含全角)时无需匹配; 绝大多数普通提问在此直接跳过
+_QUERY_DIGITS = frozenset('0123456789０１２３４５６７８９')
+
+
+def _match_query_refs(query: str):
+    """匹配查询中的图片/公式编号, 返回 (fig_match, formula_match)"""
+    if _QUERY_DIGITS.isdisjoint(query):
+        return None, None
+    fig_match = _FIG_RE.search(query) if 'fig' in query.lower() else None
+    return fig_match, _FORMULA_RE.search(query)
+
+
+# 子进程内的提取器实例 (由 _init_extract_worker 创建, 每个进程只创建一次)
+_worker_extractors = None
+
+
+def _init_extract_worker(figure_dir: str, formula_dir: str):
+    """提取子进程初始化"""
+    global _worker_extractors
+    formula_extractor = FormulaExtractor(formula_dir)
+    # 各子进程共用同一个 OCR 缓存文件, 子进程不写文件, 新条目由主进程合并后保存
+    formula_extractor.persist_cache = False
+    _worker_extractors = (FigureExtractor(figure_dir), formula_extractor)
+
+
+def _extract_one(pdf_file: str) -> Tuple[List[Dict], List[Dict], Dict[str, str]]:
+    """在子进程中提取单个PDF的图片和公式, 同时返回本次新增的 OCR 缓存条目"""
+    figure_extractor, formula_extractor = _worker_extractors
+    figures = figure_extractor.extract_figures(pdf_file)
+    formulas = formula_extractor.extract_formulas(pdf_file)
+    take_entries = getattr(formula_extractor, 'take_new_cache_entries', None)
+    return figures, formulas, take_entries() if take_entries else {}
+
+
+# 对话Prompt模板 (模块级常量, 调用时只填充检索结果和问题)
+_HYBRID_PROMPT_TMPL = """请作为模拟电路设计专家回答以下问题:
+
+{message}
+
+提示: 知识库中相关内容有限,请结合你的专业知识给出完整、详细的回答。
+"""
+
+_PROMPT_TMPL = """你是模拟电路设计领域的资深专家。
+
+【知识库检索结果】:
+{context}
+
+【用户问题】:
+{message}
+
+【回答指南】:
+1. **优先参考**检索到的知识库内容,这些是专业教材的权威信息
+2. **结合你的专业知识**对检索内容进行补充、解释和扩展
+3. 如果检索内容不完整,请基于你的领域知识进行合理推断,但需明确标注
+4. 对于公式:
+   - 解释各变量的物理含义和取值范围
+   - 说明公式的适用条件和应用场景
+   - 如有相关推导,请简要说明
+5. 对于电路图:
+   - 分析拓扑结构和关键元件
+   - 解释工作原理和信号流向
+   - 指出设计要点和常见问题
+6. 信息来源标注:
+   - 来自知识库: "根据文档X"、"教材第X页提到"
+   - 来自推断: "根据电路原理"、"通常情况下"、"从设计经验来看"
+
+【回答要求】:
+- 给出**完整、专业、深入**的技术回答
+- 即使检索内容有限,也要尽可能提供有价值的分析和见解
+- 保持技术准确性、逻辑连贯性和实用性
+- 回答要有层次,先概述再详述
+
+请详细回答:
+"""
+
+
+@functools.lru_cache(maxsize=1024)
+def _source_basename(source: str) -> str:
+    """文档路径 -> 文件名 (同一来源的多个文本块只计算一次)"""
+    return os.path.basename(source)
+
+
+def _meta_of(doc: Document) -> Tuple[str, object]:
+    """文本块的 (source, page), 缺失时为 ('未知', '?'); 旧数据中 page 可能不是 int"""
+    meta = doc.metadata or {}
+    return meta.get('source', '未知'), meta.get('page', '?')
+
+
 class RAGAgentV3Improved:
     """改进的多模态RAG智能体"""
     
+    # 检索结果缓存条数上限
+    RETRIEVAL_CACHE_SIZE = 256
+    # 语义缓存: 查询向量余弦相似度超过该阈值时复用已有检索结果
+    SEMANTIC_CACHE_THRESHOLD = 0.97
+    # 多文件提取的最大进程数 (每个进程各自加载OCR模型, 不宜过多)
+    EXTRACT_WORKERS = 4
+    
     def __init__(self, config_path: str = ".env"):
         """
         初始化RAG智能体
@@ -90,6 +196,12 @@ class RAGAgentV3Improved:
             except Exception as e:
                 print(f"⚠ 重排序器初始化失败: {e}")
         
+        # 检索结果缓存: (query, k, max_images, source_filter) -> (归一化查询向量, 检索结果)
+        # 知识库更新时清空
+        self._retrieval_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        # 图片文件是否存在 (图片只在构建索引时写入, 知识库更新时清空)
+        self._path_exists_cache: Dict[str, bool] = {}
+        
         print("\n" + "=" * 60)
         print("RAG v3-improved 初始化完成!")
         print("=" * 60 + "\n")
@@ -125,25 +237,44 @@ class RAGAgentV3Improved:
                 return False
         else:
             target_files = all_pdf_files
-            # 全量重建时才清空索引
-            self.multimodal_index.clear()
+        
+        # 清空与重新填充期间暂停索引自动保存, 只在 _ingest_files 成功后保存一次
+        with self.multimodal_index.batch():
+            if not target_filename:
+                # 全量重建时才清空索引
+                self.multimodal_index.clear()
+            ingested = self._ingest_files(target_files, full_rebuild=not target_filename)
+        return len(ingested) == len(target_files)
+    
+    def _ingest_files(self, target_files: List[str], full_rebuild: bool = False) -> List[str]:
+        """
+        处理一批PDF: 提取图片/公式 -> 更新向量库 -> 关联 -> 保存索引
+        
+        整批文件只加载一次全部文本块、只做一次关联和保存
+        
+        Args:
+            target_files: PDF文件路径列表
+            full_rebuild: 是否全量重建向量库; 否则逐个文件先删后加
+            
+        Returns:
+            向量库更新成功的文件列表
+        """
+        # 知识库即将变化, 已缓存的检索结果和图片存在性失效
+        self._retrieval_cache.clear()
+        self._path_exists_cache.clear()
         
         # 1. 提取图片和公式
         print(f"\n[步骤 1/4] 提取图片和公式 (文件数: {len(target_files)})...")
         current_figures = []
         current_formulas = []
         
-        for pdf_file in target_files:
+        for pdf_file, (figures, formulas) in zip(target_files, self._extract_files(target_files)):
             print(f"\n处理: {os.path.basename(pdf_file)}")
             
-            # 提取
-            figures = self.figure_extractor.extract_figures(pdf_file)
             current_figures.extend(figures)
-            
-            formulas = self.formula_extractor.extract_formulas(pdf_file)
             current_formulas.extend(formulas)
             
-            # 更新多模态索引
+            # 更新多模态索引 (只在主进程中修改)
             # 如果是增量更新，最好先删除旧的条目？MultimodalIndex目前不支持删，但直接覆盖ID即可
             for fig in figures:
                 self.multimodal_index.add_figure(fig)
@@ -157,48 +288,43 @@ class RAGAgentV3Improved:
         # 2. 更新向量库
         print("\n[步骤 2/4] 更新文本向量库...")
         
-        if target_filename:
-            # 增量模式: 先删后加
-            target_path = target_files[0]
-            # 1. 删除旧文档
-            self.vector_store.delete_document_by_source(os.path.basename(target_path))
-            # 2. 添加新文档
-            ok = self.vector_store.add_document(target_path)
-            if not ok:
-                print("✗ 增量更新向量库失败")
-                return False
-        else:
+        ingested = []
+        if full_rebuild:
             # 全量模式
             ok = self.vector_store.build_vectorstore(force_rebuild=True)
             if not ok:
                 print("✗ 全量构建向量库失败")
-                return False
+                return []
+            ingested = list(target_files)
+        else:
+            # 增量模式: 逐个文件先删后加
+            for target_path in target_files:
+                # 1. 删除旧文档
+                self.vector_store.delete_document_by_source(os.path.basename(target_path))
+                # 2. 添加新文档
+                if self.vector_store.add_document(target_path):
+                    ingested.append(target_path)
+                else:
+                    print(f"✗ 增量更新向量库失败: {os.path.basename(target_path)}")
+            if not ingested:
+                return []
         
         # 3. 关联文本与图片/公式
         print("\n[步骤 3/4] 关联文本与图片/公式...")
-        # 注意: 这里最好只重链当前文件的，但为了简单可靠，可以全量重链(性能损耗不大)
-        # 或者只获取新加文档的 chunks。
-        # 简单起见，重新加载所有 chunks 进行链接 (ContentLinker 比较快)
-        text_docs = self._get_all_text_chunks()
+        # 整批文件处理完后, 对所有 chunks 进行一次全量链接 (ContentLinker 比较快)
+        # 关联只取决于单个文本块与同页图片/公式, 分批读取文本块逐批关联, 结果与一次性关联相同
+        # MultimodalIndex 已包含全部(全量或增量add之后)图片和公式, 全部交给linker
+        all_figs = list(self.multimodal_index.index['figures'].values())
+        all_eqs = list(self.multimodal_index.index['formulas'].values())
+        linker = ContentLinker(self.multimodal_index)
+        
+        has_text = False
+        for text_docs in self._iter_text_chunks():
+            has_text = True
+            linker.link_documents(text_docs, all_figs, all_eqs)
         
-        if not text_docs:
+        if not has_text:
             print("⚠ 未找到文本块,跳过关联")
-        else:
-            # 需要所有图片公式来做全量链接吗？
-            # 是的，因为MultimodalIndex已经包含了所有(全量或增量add之后)
-            # 但我们需要把MultimodalIndex里已有的所有items拿出来传给linker
-            # Index类里没有直接导出所有items的方法，我们需要加一个或者...
-            # 其实ContentLinker只需要Index本身就可以工作，看它的实现。
-            # 检查 content_linker.py ... 假设它需要 index。
-            # rag_agent_v3_improved.py L162: linker = ContentLinker(self.multimodal_index)
-            # linker.link_documents 需要 figures, formulas list.
-            
-            # 小Hack: 从 index 内部 storage 获取所有 items
-            all_figs = list(self.multimodal_index.index['figures'].values())
-            all_eqs = list(self.multimodal_index.index['formulas'].values())
-            
-            linker = ContentLinker(self.multimodal_index)
-            linker.link_documents(text_docs, all_figs, all_eqs)
         
         # 4. 保存索引
         print("\n[步骤 4/4] 保存索引...")
@@ -210,7 +336,41 @@ class RAGAgentV3Improved:
         print("=" * 60)
         print("✓ 知识库更新完成!\n")
         
-        return True
+        return ingested
+    
+    def _extract_files(self, pdf_files: List[str]):
+        """
+        提取多个PDF的图片和公式, 按输入顺序逐个产出 (figures, formulas)
+        
+        各文件相互独立, 多个文件时分发到子进程并行提取; 单个文件直接在当前进程提取
+        """
+        workers = min(self.EXTRACT_WORKERS, os.cpu_count() or 1, len(pdf_files))
+        if workers <= 1:
+            for pdf_file in pdf_files:
+                yield (
+                    self.figure_extractor.extract_figures(pdf_file),
+                    self.formula_extractor.extract_formulas(pdf_file)
+                )
+            return
+        
+        # 使用 spawn 启动子进程: 主进程可能已初始化 CUDA (Pix2Text/CrossEncoder),
+        # fork 出的子进程无法再使用 CUDA; spawn 的子进程各自按需加载 Pix2Text
+        new_cache_entries = {}
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_extract_worker,
+                initargs=(self.figure_extractor.output_dir, self.formula_extractor.output_dir)
+            ) as executor:
+                for figures, formulas, cache_entries in executor.map(_extract_one, pdf_files):
+                    new_cache_entries.update(cache_entries)
+                    yield figures, formulas
+        finally:
+            # 子进程的 OCR 结果由主进程合并, 只写一次缓存文件
+            merge_cache = getattr(self.formula_extractor, 'merge_cache', None)
+            if merge_cache:
+                merge_cache(new_cache_entries)
     
     def sync_knowledge_base(self, force: bool = False):
         """
@@ -257,18 +417,15 @@ class RAGAgentV3Improved:
             for f in target_files:
                 print(f"  - {os.path.basename(f)}")
             
-        # 4. 逐个处理
-        success_count = 0
-        for i, f in enumerate(target_files, 1):
-            filename = os.path.basename(f)
-            print(f"\n>>> 处理进度 [{i}/{len(target_files)}]: {filename}")
-            if self.rebuild_knowledge_base(target_filename=filename):
-                success_count += 1
-            else:
-                print(f"✗ 文件 {filename} 处理失败")
+        # 4. 整批处理 (只做一次全量关联和保存, 期间暂停索引自动保存)
+        with self.multimodal_index.batch():
+            ingested = set(self._ingest_files(target_files))
+        for f in target_files:
+            if f not in ingested:
+                print(f"✗ 文件 {os.path.basename(f)} 处理失败")
                 
         print("\n" + "=" * 60)
-        print(f"同步完成! 成功: {success_count}/{len(target_files)}")
+        print(f"同步完成! 成功: {len(ingested)}/{len(target_files)}")
         print("=" * 60 + "\n")
     
     def retrieve_context(
@@ -279,7 +436,10 @@ class RAGAgentV3Improved:
         source_filter: str = None
     ) -> Tuple[str, List[str], List[str]]:
         """
-        检索上下文
+        检索上下文 (带缓存)
+        
+        完全相同的查询直接命中缓存; 否则与参数相同、图片/公式编号相同的已缓存查询比较
+        查询向量, 余弦相似度超过 SEMANTIC_CACHE_THRESHOLD 时复用其结果
         
         Args:
             query: 查询文本
@@ -293,62 +453,134 @@ class RAGAgentV3Improved:
         if not self.vector_store.vectorstore:
             return "", [], []
         
+        cache = self._retrieval_cache
+        key = (query, k, max_images, source_filter)
+        if key in cache:
+            cache.move_to_end(key)
+            print("[v3] 检索缓存命中")
+            return self._copy_retrieval_result(cache[key][1])
+        
+        # 查询向量只计算一次, 语义缓存比较与向量检索共用
+        try:
+            query_vec = self.embedding_model.embed_query(query)
+        except Exception as e:
+            print(f"[v3] 查询向量计算失败: {e}")
+            return "", [], []
+        
+        q_vec = np.asarray(query_vec, dtype=np.float32)
+        q_norm = np.linalg.norm(q_vec)
+        q_vec = q_vec / q_norm if q_norm > 0 else None
+        
+        if q_vec is not None:
+            signature = self._query_signature(query)
+            candidates = [
+                (cached_key, entry) for cached_key, entry in cache.items()
+                if entry[0] is not None
+                and cached_key[1:] == key[1:]
+                and self._query_signature(cached_key[0]) == signature
+            ]
+            if candidates:
+                sims = np.stack([entry[0] for _, entry in candidates]) @ q_vec
+                best = int(np.argmax(sims))
+                if sims[best] > self.SEMANTIC_CACHE_THRESHOLD:
+                    cached_key, entry = candidates[best]
+                    cache.move_to_end(cached_key)
+                    print(f"[v3] 语义检索缓存命中 (相似度 {sims[best]:.3f})")
+                    return self._copy_retrieval_result(entry[1])
+        
+        result = self._retrieve_context_uncached(query, query_vec, k, max_images, source_filter)
+        
+        cache[key] = (q_vec, result)
+        if len(cache) > self.RETRIEVAL_CACHE_SIZE:
+            cache.popitem(last=False)
+        
+        return self._copy_retrieval_result(result)
+    
+    @staticmethod
+    def _query_signature(query: str) -> tuple:
+        """查询中的图片/公式编号; 编号不同的查询即使语义相近也不能复用检索结果"""
+        fig_match, formula_match = _match_query_refs(query)
+        return (
+            f"{fig_match.group(1)} {fig_match.group(2)}".lower() if fig_match else None,
+            formula_match.group(1).strip('()[]') if formula_match else None,
+        )
+    
+    @staticmethod
+    def _copy_retrieval_result(result: tuple) -> Tuple[str, List[str], List[str]]:
+        """返回检索结果的副本, 避免调用方修改缓存中的列表"""
+        context_text, figure_paths, formula_paths = result
+        return context_text, list(figure_paths), list(formula_paths)
+    
+    def _retrieve_context_uncached(
+        self,
+        query: str,
+        query_vec: List[float],
+        k: int,
+        max_images: int,
+        source_filter: str
+    ) -> Tuple[str, List[str], List[str]]:
+        """检索上下文 (不经过缓存), query_vec 为 query 的向量, 其余参数与返回值同 retrieve_context"""
+        
         # 1. 使用MMR检索,减少冗余
-        docs = self.vector_store.search(
-            query, 
-            k=k, 
+        # 启用重排序时多取一倍候选, 由重排序截断到 k (search_by_vector 最多返回 candidate_k 个)
+        candidate_k = k * 2 if self.reranker else k
+        docs = self.vector_store.search_by_vector(
+            query_vec, 
+            k=candidate_k, 
             use_mmr=True,
-            fetch_k=k * 3,  # 先获取30个候选,再用MMR筛选出10个
+            fetch_k=self.config.retrieval_fetch_k or k * 3,  # 默认先获取30个候选,再用MMR筛选
             source_filter=source_filter
         )
         
         if not docs:
             return "", [], []
         
-        # 2. 邻近页面扩展,确保上下文完整
+        # 2. 重排序(可选): 在邻近扩展之前进行, 对候选集打分并截断到 k 个锚点
+        if self.reranker and len(docs) > k:
+            docs = self.reranker.rerank(query, docs, top_k=k)
+        
+        # 3. 以重排后的文档为锚点做邻近页面扩展,确保上下文完整
         docs = self.vector_store.expand_neighbors_by_page(
             docs,
             page_window=1,
             max_total=12  # 最终保留12个文档块
         )
         
-        # 3. 重排序(可选)
-        if self.reranker and len(docs) > k:
-            docs = self.reranker.rerank(query, docs, top_k=k)
-        
         # 4. 获取关联的图片和公式 (增强版：多策略)
-        all_figures = []
-        all_formulas = []
+        # 按ID累积, 插入时即完成去重 (dict保持插入顺序: Caption/编号命中优先, 其次按文档顺序)
+        fig_by_id: Dict[str, Dict] = {}
+        formula_by_id: Dict[str, Dict] = {}
         
         # 策略 1: 检测 query 中的 Figure/Formula 关键词，直接搜索
-        import re
-        fig_match = re.search(r'(Figure|Fig\.?)\s*(\d+)', query, re.IGNORECASE)
+        fig_match, formula_match = _match_query_refs(query)
         if fig_match:
             fig_keyword = f"{fig_match.group(1)} {fig_match.group(2)}"
             print(f"[v3] 检测到图片查询: '{fig_keyword}'，使用 Caption 搜索")
             caption_figs = self.multimodal_index.search_figures_by_caption(fig_keyword, source_filter)
-            all_figures.extend(caption_figs)
+            self._merge_by_id(fig_by_id, caption_figs, 'figure_id')
         
-        formula_match = re.search(r'(\d+\.\d+|\(\d+\)|\[\d+\])', query)
         if formula_match:
             formula_num = formula_match.group(1).strip('()[]')
             print(f"[v3] 检测到公式查询: '{formula_num}'，使用编号搜索")
             caption_formulas = self.multimodal_index.search_formulas_by_id(formula_num, source_filter)
-            all_formulas.extend(caption_formulas)
+            self._merge_by_id(formula_by_id, caption_formulas, 'formula_id')
         
         # 策略 2: 基于检索到的文本块，按 Page 查找图片和公式
-        for doc in docs:
-            meta = doc.metadata or {}
-            source = meta.get('source', '')
-            page = meta.get('page', -1)
+        # 同一遍循环中组装文本上下文 (与后面的图片/公式信息一起单次 join)
+        doc_parts = []
+        for i, doc in enumerate(docs, 1):
+            source, page = _meta_of(doc)
+            source_name = _source_basename(source) if source != '未知' else source
+            doc_parts.append(f"[文档{i}] 来源: {source_name}, 页码: {page}\n{doc.page_content}\n")
             
-            if source and page >= 0:
+            # 页码为 int 时才按页查找 (旧数据中可能是 str 或 None)
+            if source and source != '未知' and isinstance(page, int) and page >= 0:
                 # 获取同一页的图片
-                page_figs = self.multimodal_index.get_figures_by_page(os.path.basename(source), page)
+                page_figs = self.multimodal_index.get_figures_by_page(source_name, page)
                 # 确保page_figs是列表，如果是字典则转换为列表
                 if isinstance(page_figs, dict):
                     page_figs = list(page_figs.values())
-                all_figures.extend(page_figs)
+                self._merge_by_id(fig_by_id, page_figs, 'figure_id')
             
             # 保留原有的 chunk_id 关联逻辑作为备选
             figures = self.multimodal_index.get_related_figures(doc)
@@ -358,12 +590,12 @@ class RAGAgentV3Improved:
                 figures = list(figures.values())
             if isinstance(formulas, dict):
                 formulas = list(formulas.values())
-            all_figures.extend(figures)
-            all_formulas.extend(formulas)
+            self._merge_by_id(fig_by_id, figures, 'figure_id')
+            self._merge_by_id(formula_by_id, formulas, 'formula_id')
         
-        # 5. 去重
-        unique_figures = self._deduplicate_by_id(all_figures, 'figure_id')
-        unique_formulas = self._deduplicate_by_id(all_formulas, 'formula_id')
+        # 5. 去重结果
+        unique_figures = list(fig_by_id.values())
+        unique_formulas = list(formula_by_id.values())
         
         print(f"[v3] 多模态检索完成: {len(unique_figures)} 个图片, {len(unique_formulas)} 个公式")
         
@@ -374,18 +606,8 @@ class RAGAgentV3Improved:
         remaining = max(0, max_images - len(figure_paths))
         formula_paths = [f['image_path'] for f in unique_formulas[:remaining]]
         
-        # 7. 组装文本上下文
+        # 7. 添加图片和公式信息
         context_parts = []
-        for i, doc in enumerate(docs, 1):
-            meta = doc.metadata or {}
-            source = meta.get('source', '未知')
-            page = meta.get('page', '?')
-            source_name = os.path.basename(source) if source != '未知' else source
-            context_parts.append(
-                f"[文档{i}] 来源: {source_name}, 页码: {page}\n{doc.page_content}\n"
-            )
-        
-        # 8. 添加图片和公式信息
         if unique_figures:
             context_parts.append("\n【相关图片】:")
             for fig in unique_figures[:remaining]:
@@ -408,7 +630,7 @@ class RAGAgentV3Improved:
                 else:
                     context_parts.append(f"- {text} (页码: {eq['page']})")
         
-        context_text = "\n".join(context_parts)
+        context_text = "\n".join(chain(doc_parts, context_parts))
         
         return context_text, figure_paths, formula_paths
     
@@ -431,8 +653,24 @@ class RAGAgentV3Improved:
         Returns:
             AI回复
         """
+        return "".join(self.chat_stream(message, use_rag=use_rag, k=k, max_images=max_images))
+    
+    def chat_stream(
+        self, 
+        message: str, 
+        use_rag: bool = True, 
+        k: int = 5,
+        max_images: int = 6
+    ) -> Iterator[str]:
+        """
+        流式多模态对话接口 (参数同 chat)
+        
+        Yields:
+            AI回复片段, 按生成顺序返回
+        """
         if not use_rag or not self.vector_store.vectorstore:
-            return self.chat_model.chat(message)
+            yield from self.chat_model.chat_stream(message)
+            return
         
         # 检索上下文
         context, fig_paths, eq_paths = self.retrieve_context(message, k=k, max_images=max_images)
@@ -441,60 +679,19 @@ class RAGAgentV3Improved:
         if not context or len(context) < 100:
             print("[RAG] 检索内容不足,使用混合模式")
             # 使用混合Prompt,允许LLM自由发挥
-            hybrid_prompt = f"""请作为模拟电路设计专家回答以下问题:
-
-{message}
-
-提示: 知识库中相关内容有限,请结合你的专业知识给出完整、详细的回答。
-"""
-            return self.chat_model.chat(hybrid_prompt)
+            hybrid_prompt = _HYBRID_PROMPT_TMPL.format_map({"message": message})
+            yield from self.chat_model.chat_stream(hybrid_prompt)
+            return
         
         # 合并图片和公式路径
         all_images = eq_paths + fig_paths  # 公式优先
         
         # 构建优化的Prompt - 允许LLM结合自身知识
-        prompt = f"""你是模拟电路设计领域的资深专家。
-
-【知识库检索结果】:
-{context}
-
-【用户问题】:
-{message}
-
-【回答指南】:
-1. **优先参考**检索到的知识库内容,这些是专业教材的权威信息
-2. **结合你的专业知识**对检索内容进行补充、解释和扩展
-3. 如果检索内容不完整,请基于你的领域知识进行合理推断,但需明确标注
-4. 对于公式:
-   - 解释各变量的物理含义和取值范围
-   - 说明公式的适用条件和应用场景
-   - 如有相关推导,请简要说明
-5. 对于电路图:
-   - 分析拓扑结构和关键元件
-   - 解释工作原理和信号流向
-   - 指出设计要点和常见问题
-6. 信息来源标注:
-   - 来自知识库: "根据文档X"、"教材第X页提到"
-   - 来自推断: "根据电路原理"、"通常情况下"、"从设计经验来看"
-
-【回答要求】:
-- 给出**完整、专业、深入**的技术回答
-- 即使检索内容有限,也要尽可能提供有价值的分析和见解
-- 保持技术准确性、逻辑连贯性和实用性
-- 回答要有层次,先概述再详述
-
-请详细回答:
-"""
-        
-        # 调用多模态LLM
-        if all_images:
-            # 过滤不存在的图片
-            valid_images = [img for img in all_images if os.path.exists(img)]
-            if valid_images:
-                return self.chat_model.chat_with_images(prompt, valid_images)
+        prompt = _PROMPT_TMPL.format_map({"context": context, "message": message})
         
-        # 没有图片或图片不存在,使用纯文本
-        return self.chat_model.chat(prompt)
+        # 调用多模态LLM (过滤不存在的图片, 没有图片时为纯文本对话)
+        valid_images = [img for img in all_images if self._path_exists(img)]
+        yield from self.chat_model.chat_stream(prompt, valid_images)
     
     def search_knowledge_base(
         self, 
@@ -530,6 +727,26 @@ class RAGAgentV3Improved:
         
         return docs, unique_figures, unique_formulas
     
+    def _path_exists(self, path: str) -> bool:
+        """带缓存的文件存在性检查"""
+        exists = self._path_exists_cache.get(path)
+        if exists is None:
+            try:
+                os.stat(path)
+                exists = True
+            except OSError:
+                exists = False
+            self._path_exists_cache[path] = exists
+        return exists
+    
+    @staticmethod
+    def _merge_by_id(acc: Dict[str, Dict], items: List[Dict], id_key: str):
+        """将条目按ID并入累积字典, 已存在的ID保留先加入的条目"""
+        for item in items:
+            item_id = item.get(id_key)
+            if item_id and item_id not in acc:
+                acc[item_id] = item
+    
     def _deduplicate_by_id(self, items: List[Dict], id_key: str) -> List[Dict]:
         """按ID去重"""
         seen = set()
@@ -550,30 +767,67 @@ class RAGAgentV3Improved:
             print(f"⚠ 文档目录不存在: {docs_dir}")
             return []
         
-        for root, _, files in os.walk(docs_dir):
-            for f in files:
-                if f.lower().endswith('.pdf'):
-                    pdf_files.append(os.path.join(root, f))
+        # 基于 os.scandir 的迭代遍历 (目录项类型来自 scandir 本身, 无需额外 stat)
+        # 子目录逆序入栈, 结果顺序与 os.walk 自顶向下遍历一致
+        stack = [docs_dir]
+        while stack:
+            current = stack.pop()
+            subdirs = []
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.lower().endswith('.pdf'):
+                            pdf_files.append(entry.path)
+            except OSError as e:
+                print(f"⚠ 无法读取目录: {current} ({e})")
+                continue
+            stack.extend(reversed(subdirs))
         
         return pdf_files
     
-    def _get_all_text_chunks(self) -> List[Document]:
-        """获取向量库中的所有文本块"""
+    def _iter_text_chunks(self, batch_size: int = 2000) -> Iterator[List[Document]]:
+        """
+        分批获取向量库中的所有文本块
+        
+        按 limit/offset 分页读取, 内存中同时只保留一批文本
+        (ContentLinker 需要正文做引用匹配, chunk_id 也由正文哈希得到, 因此不能只取metadata)
+        
+        Args:
+            batch_size: 每批文本块数量
+            
+        Yields:
+            文本块列表
+        """
         if not self.vector_store.vectorstore:
-            return []
+            return
         
-        try:
-            data = self.vector_store.vectorstore.get(include=["documents", "metadatas"])
+        offset = 0
+        while True:
+            try:
+                data = self.vector_store.vectorstore.get(
+                    include=["documents", "metadatas"],
+                    limit=batch_size,
+                    offset=offset
+                )
+            except Exception as e:
+                print(f"[RAGAgentV3Improved] 获取文本块失败: {e}")
+                return
+            
             documents = data.get("documents", [])
             metadatas = data.get("metadatas", [])
+            if not documents:
+                return
             
-            return [
+            yield [
                 Document(page_content=doc, metadata=meta)
                 for doc, meta in zip(documents, metadatas)
             ]
-        except Exception as e:
-            print(f"[RAGAgentV3Improved] 获取文本块失败: {e}")
-            return []
+            
+            if len(documents) < batch_size:
+                return
+            offset += batch_size
 
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@
 使用交叉编码器对检索结果进行重排序,提高相关性
 """
 from typing import List
+import numpy as np
 from langchain_core.documents import Document
 
 
@@ -34,29 +35,23 @@ class SimpleReRanker:
             return []
         
         # 提取查询关键词
-        query_terms = set(query.lower().split())
+        query_terms = list(set(query.lower().split()))
         
-        # 计算每个文档的分数
-        scored_docs = []
-        for doc in docs:
-            content = doc.page_content.lower()
-            
-            # 计算关键词匹配度
-            matches = sum(1 for term in query_terms if term in content)
-            
-            # 计算TF (词频)
-            tf_score = sum(content.count(term) for term in query_terms)
-            
-            # 综合分数
-            score = matches * 2 + tf_score
-            
-            scored_docs.append((doc, score))
+        # 词频矩阵 (文档 × 关键词), 每个关键词在每个文档中只扫描一次
+        tf = np.array(
+            [[content.count(term) for term in query_terms]
+             for content in (doc.page_content.lower() for doc in docs)],
+            dtype=np.int64
+        ).reshape(len(docs), len(query_terms))
         
-        # 按分数排序
-        scored_docs.sort(key=lambda x: x[1], reverse=True)
+        # 综合分数 = 命中关键词数 × 2 + 总词频
+        scores = (tf > 0).sum(axis=1) * 2 + tf.sum(axis=1)
+        
+        # 稳定排序: 同分文档保持原检索顺序
+        order = np.argsort(-scores, kind='stable')[:top_k]
         
         # 返回top_k
-        reranked = [doc for doc, score in scored_docs[:top_k]]
+        reranked = [docs[i] for i in order]
         
         print(f"[ReRanker] 重排序完成: {len(docs)} -> {len(reranked)} 个文档")
         return reranked
@@ -65,20 +60,65 @@ class SimpleReRanker:
 # 可选: 使用CrossEncoder的高级重排序器
 try:
     from sentence_transformers import CrossEncoder
+    import torch
     
     class CrossEncoderReRanker:
         """基于CrossEncoder的重排序器"""
         
+        # 推理批大小
+        BATCH_SIZE = 64
+        # CPU推理时优先使用的ONNX Runtime int8动态量化模型文件 (模型仓库中不存在时回退到PyTorch)
+        ONNX_INT8_FILE = "onnx/model_quint8_avx2.onnx"
+        
         def __init__(self, model_name: str = 'cross-encoder/ms-marco-MiniLM-L-6-v2'):
             """
-            初始化CrossEncoder重排序器
+            初始化CrossEncoder重排序器 (模型在第一次重排序时才加载)
             
             Args:
                 model_name: 模型名称
             """
-            print(f"[ReRanker] 加载CrossEncoder模型: {model_name}")
-            self.model = CrossEncoder(model_name)
+            self.model_name = model_name
+            self._model = None
+            # 模型加载失败后改用的简单重排序器 (失败状态锁定, 不在每次查询时重试加载)
+            self._fallback = None
+        
+        @property
+        def model(self):
+            """CrossEncoder模型, 首次访问时加载; 加载失败时为 None"""
+            if self._model is None and self._fallback is None:
+                try:
+                    self._model = self._load_model()
+                except Exception as e:
+                    print(f"[ReRanker] ⚠ CrossEncoder加载失败, 改用简单重排序器: {e}")
+                    self._fallback = SimpleReRanker()
+            return self._model
+        
+        def _load_model(self):
+            """
+            加载CrossEncoder模型
+            
+            - GPU: PyTorch + FP16
+            - CPU: 优先 ONNX Runtime int8 量化模型, 不可用时使用 PyTorch FP32
+            """
+            print(f"[ReRanker] 加载CrossEncoder模型: {self.model_name}")
+            if torch.cuda.is_available():
+                model = CrossEncoder(self.model_name)
+                # GPU上使用FP16推理, 显存带宽减半
+                model.model.half()
+                print("[ReRanker] CrossEncoder使用FP16推理")
+            else:
+                try:
+                    model = CrossEncoder(
+                        self.model_name,
+                        backend="onnx",
+                        model_kwargs={"file_name": self.ONNX_INT8_FILE}
+                    )
+                    print("[ReRanker] CrossEncoder使用ONNX Runtime int8推理")
+                except Exception as e:
+                    print(f"[ReRanker] ONNX int8模型不可用, 使用PyTorch推理: {e}")
+                    model = CrossEncoder(self.model_name)
             print("[ReRanker] CrossEncoder加载成功")
+            return model
         
         def rerank(
             self, 
@@ -100,17 +140,31 @@ try:
             if not docs:
                 return []
             
-            # 构建查询-文档对
-            pairs = [[query, doc.page_content] for doc in docs]
+            model = self.model
+            if model is None:
+                return self._fallback.rerank(query, docs, top_k=top_k)
+            
+            # 按文档长度排序后构建查询-文档对, 长度相近的放在同一批次以减少padding
+            by_length = sorted(range(len(docs)), key=lambda i: len(docs[i].page_content))
+            pairs = [[query, docs[i].page_content] for i in by_length]
             
             # 预测相关性分数
-            scores = self.model.predict(pairs)
+            sorted_scores = model.predict(
+                pairs,
+                batch_size=self.BATCH_SIZE,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            )
+            
+            # 还原为原文档顺序
+            scores = np.empty(len(docs), dtype=np.float32)
+            scores[by_length] = sorted_scores
             
-            # 按分数排序
-            ranked = sorted(zip(docs, scores), key=lambda x: x[1], reverse=True)
+            # 按分数排序 (稳定排序, 同分文档保持原顺序)
+            order = np.argsort(-scores, kind='stable')[:top_k]
             
             # 返回top_k
-            reranked = [doc for doc, score in ranked[:top_k]]
+            reranked = [docs[i] for i in order]
             
             print(f"[ReRanker] CrossEncoder重排序完成: {len(docs)} -> {len(reranked)} 个文档")
             return reranked
@@ -129,9 +129,10 @@ def main():
                 
                 # 进行对话
                 print(f"\n智能体 v3-improved [RAG: {'ON' if use_rag else 'OFF'}]:")
-                response = agent.chat(user_input, use_rag=use_rag)
-                print(response)
-                print()
+                # 流式输出, 首个片段到达即开始显示
+                for chunk in agent.chat_stream(user_input, use_rag=use_rag):
+                    print(chunk, end='', flush=True)
+                print("\n")
                 
             except KeyboardInterrupt:
                 print("\n\n再见!")
@@ -0,0 +1,34 @@
+# 测试 FormulaExtractorOCR 的公式 text 字段包含公式内容块的文本 (不再只有编号)
+
+import os
+import tempfile
+
+import fitz  # PyMuPDF
+
+from formula_extractor_ocr import FormulaExtractorOCR
+
+print("=" * 60)
+print("测试公式文本字段")
+print("=" * 60)
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    # 构造单页PDF: 左侧公式内容, 右侧公式编号 (编号略低于公式, 两者成为独立文本块)
+    pdf_path = os.path.join(tmp_dir, "formula_sample.pdf")
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((72, 200), "V_OUT = V_REF x (1 + R1/R2)", fontsize=11)
+    page.insert_text((500, 220), "(3.1)", fontsize=11)
+    doc.save(pdf_path)
+    doc.close()
+
+    extractor = FormulaExtractorOCR(output_dir=os.path.join(tmp_dir, "formulas"))
+    # 不加载Pix2Text, 只检查基于文本块的结果
+    extractor._p2t_loaded = True
+
+    formulas = extractor.extract_formulas(pdf_path)
+
+    assert len(formulas) == 1, f"应提取到1个公式, 实际 {len(formulas)}"
+    text = formulas[0]['text']
+    assert "V_OUT = V_REF" in text, f"text 应包含公式内容: {text!r}"
+    assert text.endswith("(3.1)"), f"text 应以编号结尾: {text!r}"
+    print(f"\n✓ 公式文本: {text}")
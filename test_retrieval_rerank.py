@@ -0,0 +1,78 @@
+# 测试检索链路中重排序器确实被调用 (候选集多于 k 时重排序截断到 k, 再做邻近页面扩展)
+
+from langchain_core.documents import Document
+
+from rag_agent_v3_improved import RAGAgentV3Improved
+
+
+class FakeVectorStore:
+    """按请求数量返回候选, 记录调用参数"""
+
+    def __init__(self):
+        self.search_kwargs = None
+        self.expand_input = None
+
+    def search_by_vector(self, query_vec, k=5, use_mmr=True, fetch_k=20, source_filter=None):
+        self.search_kwargs = {'k': k, 'fetch_k': fetch_k}
+        return [
+            Document(page_content=f"chunk {i}", metadata={'source': 'a.pdf', 'page': i})
+            for i in range(k)
+        ]
+
+    def expand_neighbors_by_page(self, docs, page_window=1, max_total=12):
+        self.expand_input = list(docs)
+        return docs
+
+
+class FakeReRanker:
+    """倒序返回前 top_k 个文档, 记录调用"""
+
+    def __init__(self):
+        self.calls = []
+
+    def rerank(self, query, docs, top_k=10):
+        self.calls.append((len(docs), top_k))
+        return list(reversed(docs))[:top_k]
+
+
+class FakeMultimodalIndex:
+    def get_figures_by_page(self, source, page):
+        return []
+
+    def get_related_figures(self, doc):
+        return []
+
+    def get_related_formulas(self, doc):
+        return []
+
+
+class FakeConfig:
+    retrieval_fetch_k = None
+
+
+print("=" * 60)
+print("测试检索链路中的重排序")
+print("=" * 60)
+
+agent = RAGAgentV3Improved.__new__(RAGAgentV3Improved)
+agent.config = FakeConfig()
+agent.vector_store = FakeVectorStore()
+agent.reranker = FakeReRanker()
+agent.multimodal_index = FakeMultimodalIndex()
+agent._path_exists_cache = {}
+
+k = 5
+agent._retrieve_context_uncached("what is the ldo", [0.0], k, 6, None)
+
+assert agent.vector_store.search_kwargs['k'] > k, "启用重排序时应多取候选"
+assert agent.reranker.calls == [(k * 2, k)], f"重排序调用不符合预期: {agent.reranker.calls}"
+assert len(agent.vector_store.expand_input) == k, "邻近扩展的锚点应为重排后的 k 个文档"
+assert agent.vector_store.expand_input[0].metadata['page'] == k * 2 - 1, "邻近扩展应使用重排后的顺序"
+print(f"\n✓ 重排序已调用: {agent.reranker.calls[0][0]} -> {agent.reranker.calls[0][1]} 个文档")
+
+# 未启用重排序时按 k 检索
+agent.reranker = None
+agent.vector_store = FakeVectorStore()
+agent._retrieve_context_uncached("what is the ldo", [0.0], k, 6, None)
+assert agent.vector_store.search_kwargs['k'] == k, "未启用重排序时应只取 k 个候选"
+print("✓ 未启用重排序时检索 k 个候选")
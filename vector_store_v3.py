@@ -2,9 +2,16 @@
 v3 向量数据库构建模块
 复用 Qwen Embedding, 但使用独立的持久化目录与集合名, 供多模态 RAG 使用。
 """
+import asyncio
+import hashlib
+import json
 import os
-from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
 
+import chromadb
+import numpy as np
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import (
     TextLoader,
@@ -18,10 +25,216 @@ from langchain_core.documents import Document
 from qwen_embedding import QwenEmbedding
 from config_v3 import ConfigV3
 
+# 可选: Rust 实现的文本切分器 (按字符数切分, 与 length_function=len 一致), 未安装时使用 LangChain 切分器
+try:
+    from semantic_text_splitter import TextSplitter as RustTextSplitter
+except ImportError:
+    RustTextSplitter = None
+
+# 文本块去重只需快速指纹; 优先使用 xxh3, 未安装时回退到内置 hash
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def _chunk_doc_id(doc: Document) -> str:
+    """文本块在向量库中的ID: 由来源、页码和内容决定, 同一文本块重复入库时ID不变"""
+    meta = doc.metadata or {}
+    key = f"{meta.get('source', '')}|{meta.get('page', '')}|{doc.page_content}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _content_key(text: str) -> int:
+    """文本块内容指纹 (用于结果去重)"""
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(text.encode("utf-8", "ignore"))
+    return hash(text)
+
+
+def _mmr_select(
+    query_vec: np.ndarray,
+    embeddings: np.ndarray,
+    k: int,
+    lambda_mult: float = 0.5
+) -> List[int]:
+    """
+    MMR(最大边际相关性) 贪心选择, 与 LangChain 的 maximal_marginal_relevance 结果一致
+    
+    候选间相似度矩阵只计算一次, 每一步只需维护"与已选集合的最大相似度"数组
+    
+    Returns:
+        选中候选的下标列表 (按选择顺序)
+    """
+    if k <= 0 or embeddings.size == 0:
+        return []
+
+    norms = np.linalg.norm(embeddings, axis=1)
+    norms[norms == 0] = np.inf
+    unit = embeddings / norms[:, None]
+    q_norm = np.linalg.norm(query_vec)
+    relevance = unit @ (query_vec / q_norm) if q_norm else np.zeros(len(unit), dtype=unit.dtype)
+    sim = unit @ unit.T
+
+    k = min(k, len(unit))
+    selected = [int(np.argmax(relevance))]
+    max_sim = sim[:, selected[0]].copy()
+    chosen = np.zeros(len(unit), dtype=bool)
+    chosen[selected[0]] = True
+
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_sim
+        scores[chosen] = -np.inf
+        picked = int(np.argmax(scores))
+        selected.append(picked)
+        chosen[picked] = True
+        max_sim = np.maximum(max_sim, sim[:, picked])
+
+    return selected
+
+
+# 支持加载的文档类型: 扩展名 -> loader 构造函数
+_LOADERS = {
+    ".txt": lambda p: TextLoader(p, encoding="utf-8"),
+    ".md": UnstructuredMarkdownLoader,
+    ".pdf": PyMuPDFLoader,
+    ".json": lambda p: JSONLoader(p, jq_schema=".", text_content=False),
+}
+
+
+def _iter_document_files(root: str) -> Iterator[str]:
+    """
+    遍历目录下支持加载的文档 (基于 os.scandir, 目录项类型来自 scandir 本身, 无需额外 stat)
+    
+    子目录逆序入栈, 输出顺序与 os.walk 自顶向下遍历一致
+    """
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in _LOADERS:
+                        yield entry.path
+        except OSError as e:
+            print(f"[v3] 无法读取目录: {current} ({e})")
+            continue
+        stack.extend(reversed(subdirs))
+
+
+def _clean_text(text) -> str:
+    """去除 NUL 字符并把连续空白折叠为单个空格, 清洗后为空时返回占位文本"""
+    if text is None:
+        text = ""
+    elif not isinstance(text, str):
+        text = str(text)
+    # str.split() 无参数时按任意空白切分并丢弃首尾空白
+    # 不改用 re.sub(r"\s+", " ", ...): 实测页面大小文本慢约3倍, 10MB文本慢约3倍且峰值内存更高
+    return " ".join(text.replace("\x00", "").split()) or "[空文档]"
+
+
+# Chroma 可直接存储的元数据值类型
+_SCALAR_TYPES = frozenset((str, int, float, bool))
+
+
+def _clean_documents(docs: List[Document]) -> List[Document]:
+    """批量清洗文档 (原地修改), 基础清洗逻辑与 v2 类似, 保证文本/元数据可用"""
+    for doc in docs:
+        doc.page_content = _clean_text(doc.page_content)
+        # 常见情况 (如 PyMuPDF 的页面元数据) 所有值已是标量, 原样保留, 不重建字典
+        if doc.metadata and not all(type(v) in _SCALAR_TYPES for v in doc.metadata.values()):
+            doc.metadata = {
+                k: v if isinstance(v, (str, int, float, bool)) else str(v)
+                for k, v in doc.metadata.items()
+                if v is not None
+            }
+    return docs
+
+
+def _load_one(file_path: str) -> List[Document]:
+    """加载并清洗单个文档 (模块级函数, 可在子进程中执行)"""
+    file_ext = os.path.splitext(file_path)[1].lower()
+
+    factory = _LOADERS.get(file_ext)
+    if factory is None:
+        print(f"[v3] 不支持的文件格式: {file_ext}")
+        return []
+
+    try:
+        loader = factory(file_path)
+        # 清洗后的文本不会为空 (空文档以占位文本代替)
+        cleaned_docs = _clean_documents(loader.load())
+        # 记录源文件名, 增量更新时可直接按 where 条件定位同一文件的文本块
+        for d in cleaned_docs:
+            source = d.metadata.get("source") if d.metadata else None
+            if source:
+                d.metadata["source_basename"] = os.path.basename(source)
+
+        if cleaned_docs:
+            print(f"[v3] 加载文档: {os.path.basename(file_path)}, 有效片段 {len(cleaned_docs)}")
+        else:
+            print(f"[v3] 文档无有效内容: {os.path.basename(file_path)}")
+
+        return cleaned_docs
+
+    except Exception as e:
+        print(f"[v3] 加载文档失败 {file_path}: {e}")
+        return []
+
+
+def _make_splitters(chunk_size: int, chunk_overlap: int):
+    """创建 (LangChain切分器, Rust切分器或None)"""
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+    )
+    fast_splitter = None
+    if RustTextSplitter is not None:
+        try:
+            fast_splitter = RustTextSplitter(chunk_size, overlap=chunk_overlap)
+        except Exception as e:
+            print(f"[v3] Rust文本切分器初始化失败, 使用LangChain切分器: {e}")
+    return text_splitter, fast_splitter
+
+
+def _split_long_document(doc: Document, text_splitter, fast_splitter) -> List[Document]:
+    """切分一个超过 chunk_size 的文档"""
+    if fast_splitter is not None:
+        return [
+            Document(page_content=chunk, metadata=dict(doc.metadata))
+            for chunk in fast_splitter.chunks(doc.page_content)
+        ]
+    return text_splitter.split_documents([doc])
+
+
+# 子进程内的切分器 (由 _init_split_worker 创建, 每个进程只创建一次)
+_worker_splitters = None
+
+
+def _init_split_worker(chunk_size: int, chunk_overlap: int):
+    """切分子进程初始化"""
+    global _worker_splitters
+    _worker_splitters = _make_splitters(chunk_size, chunk_overlap)
+
+
+def _split_in_worker(doc: Document) -> List[Document]:
+    """在子进程中切分单个文档"""
+    return _split_long_document(doc, *_worker_splitters)
+
 
 class VectorStoreV3:
     """v3 向量数据库管理类"""
 
+    # 需要切分的长文档达到该数量时才使用多进程 (进程启动与文档序列化有固定开销)
+    PARALLEL_SPLIT_MIN_DOCS = 64
+    # 流式构建时每次切分的文档数 / 每次写入向量库的片段数 (内存峰值与之成正比, 与语料总量无关)
+    STREAM_SPLIT_DOCS = 1024
+    STREAM_ADD_CHUNKS = 4096
+
     def __init__(self, config: ConfigV3, embedding_model: QwenEmbedding):
         self.config = config
         self.embedding_model = embedding_model
@@ -30,149 +243,291 @@ class VectorStoreV3:
         self.documents_dir = doc_cfg["documents_dir"]
         self.chunk_size = int(doc_cfg["chunk_size"])
         self.chunk_overlap = int(doc_cfg["chunk_overlap"])
+        self.load_workers = max(1, int(doc_cfg.get("load_workers", 1)))
 
         vs_cfg = config.get_vectorstore_config()
         self.persist_directory = vs_cfg["persist_directory"]
         self.collection_name = vs_cfg["collection_name"]
+        # Chroma 底层 HNSW 近似最近邻索引参数 (仅在创建集合时写入)
+        self.collection_metadata = {
+            "hnsw:space": "cosine",
+            "hnsw:M": vs_cfg["hnsw_m"],
+            "hnsw:construction_ef": vs_cfg["hnsw_construction_ef"],
+            "hnsw:search_ef": vs_cfg["hnsw_search_ef"],
+            "hnsw:sync_threshold": vs_cfg["hnsw_sync_threshold"],
+        }
 
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-            length_function=len,
-        )
+        self.text_splitter, self.fast_splitter = _make_splitters(self.chunk_size, self.chunk_overlap)
 
         self.vectorstore: Optional[Chroma] = None
+        self.ingest_batch_size = max(1, int(vs_cfg.get("ingest_batch_size", 512)))
 
-    # 基础清洗逻辑与 v2 类似, 保证文本/元数据可用
-    def clean_document_content(self, doc: Document) -> Document:
-        if doc.page_content is None:
-            doc.page_content = ""
-        elif not isinstance(doc.page_content, str):
-            doc.page_content = str(doc.page_content)
-
-        doc.page_content = doc.page_content.strip()
-        doc.page_content = doc.page_content.replace("\x00", "")
-        doc.page_content = " ".join(doc.page_content.split())
+        # int8 量化粗排索引 (首次检索时从向量库构建, 向量库变化时失效)
+        self.use_int8_embed = bool(vs_cfg.get("use_int8_embed", False))
+        self._int8_ids: Optional[List[str]] = None
+        self._int8_matrix: Optional[np.ndarray] = None
+        self._int8_scale: Optional[np.ndarray] = None
+        # int8 索引持久化副本, 进程重启后无需再全量读取 FP32 向量重新量化
+        self._int8_path = os.path.join(self.persist_directory, "int8_index.npz")
 
-        if not doc.page_content:
-            doc.page_content = "[空文档]"
+        # 已索引源文件名集合 (持久化到 sources.json, 增删文档时同步更新, 无需全表扫描)
+        self._sources_path = os.path.join(self.persist_directory, "sources.json")
+        self._sources: Optional[set] = None
 
-        if doc.metadata:
-            cleaned = {}
-            for k, v in doc.metadata.items():
-                if isinstance(v, (str, int, float, bool)):
-                    cleaned[k] = v
-                elif v is not None:
-                    cleaned[k] = str(v)
-            doc.metadata = cleaned
+        # 全量 (ids, metadatas) 缓存, 增量更新时多次全表读取只做一次 (向量库变化时失效)
+        self._meta_cache: Optional[Tuple[List[str], List[dict]]] = None
 
-        return doc
+    # 基础清洗逻辑与 v2 类似, 保证文本/元数据可用
+    def clean_document_content(self, doc: Document) -> Document:
+        return _clean_documents([doc])[0]
 
     def load_document(self, file_path: str) -> List[Document]:
-        file_ext = os.path.splitext(file_path)[1].lower()
-
-        try:
-            if file_ext == ".txt":
-                loader = TextLoader(file_path, encoding="utf-8")
-            elif file_ext == ".md":
-                loader = UnstructuredMarkdownLoader(file_path)
-            elif file_ext == ".pdf":
-                loader = PyMuPDFLoader(file_path)
-            elif file_ext == ".json":
-                loader = JSONLoader(
-                    file_path,
-                    jq_schema=".",
-                    text_content=False,
-                )
-            else:
-                print(f"[v3] 不支持的文件格式: {file_ext}")
-                return []
-
-            docs = loader.load()
-            cleaned_docs: List[Document] = []
-            for d in docs:
-                try:
-                    cleaned = self.clean_document_content(d)
-                    if cleaned.page_content and cleaned.page_content.strip():
-                        cleaned_docs.append(cleaned)
-                except Exception as e:
-                    print(f"[v3] 清理文档片段失败: {e}")
-                    continue
-
-            if cleaned_docs:
-                print(f"[v3] 加载文档: {os.path.basename(file_path)}, 有效片段 {len(cleaned_docs)}")
-            else:
-                print(f"[v3] 文档无有效内容: {os.path.basename(file_path)}")
-
-            return cleaned_docs
-
-        except Exception as e:
-            print(f"[v3] 加载文档失败 {file_path}: {e}")
-            return []
+        return _load_one(file_path)
 
     def load_documents_from_directory(self) -> List[Document]:
+        all_docs = list(self.iter_documents())
+        print(f"[v3] 总共加载 {len(all_docs)} 个文档片段")
+        return all_docs
+
+    def iter_documents(self) -> Iterator[Document]:
+        """
+        逐个生成文档目录下加载并清洗后的文档 (不在内存中保留整个语料)
+        
+        多进程加载时按窗口提交文件, 同时驻留内存的只有一个窗口的加载结果
+        """
         if not os.path.exists(self.documents_dir):
             print(f"[v3] 文档目录不存在: {self.documents_dir}")
-            return []
-
-        all_docs: List[Document] = []
-        exts = [".txt", ".md", ".pdf", ".json"]
+            return
 
         print(f"[v3] 开始加载文档目录: {self.documents_dir}")
-        for root, _, files in os.walk(self.documents_dir):
-            for f in files:
-                if os.path.splitext(f)[1].lower() in exts:
-                    fp = os.path.join(root, f)
-                    docs = self.load_document(fp)
-                    all_docs.extend(docs)
+        all_files = list(_iter_document_files(self.documents_dir))
 
-        print(f"[v3] 总共加载 {len(all_docs)} 个文档片段")
-        return all_docs
+        workers = min(self.load_workers, len(all_files))
+        if workers < 2:
+            for fp in all_files:
+                yield from _load_one(fp)
+            return
+
+        # 各文件的解析相互独立, 多进程并行; map 按提交顺序返回, 结果顺序与顺序加载一致
+        print(f"[v3] 并行加载 {len(all_files)} 个文件 ({workers} 个进程)")
+        window = workers * 2
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(all_files), window):
+                for docs in pool.map(_load_one, all_files[start : start + window]):
+                    yield from docs
+
+    def iter_split(self, doc_iter: Iterable[Document]) -> Iterator[Document]:
+        """按 STREAM_SPLIT_DOCS 分组切分文档流, 逐个生成片段"""
+        doc_iter = iter(doc_iter)
+        while True:
+            group = list(islice(doc_iter, self.STREAM_SPLIT_DOCS))
+            if not group:
+                return
+            yield from self.split_documents(group)
 
     def split_documents(self, docs: List[Document]) -> List[Document]:
         if not docs:
             return []
         try:
-            splitted = self.text_splitter.split_documents(docs)
-            print(f"[v3] 文档切分完成: {len(docs)} -> {len(splitted)} 个片段")
+            # 不超过 chunk_size 的文档(如PDF的短页面)切分后仍是原文, 直接保留; 只对长文档调用切分器
+            long_docs = [doc for doc in docs if len(doc.page_content) > self.chunk_size]
+            chunks_of_long = iter(self._split_long_documents(long_docs))
+
+            splitted: List[Document] = []
+            for doc in docs:
+                if len(doc.page_content) <= self.chunk_size:
+                    splitted.append(doc)
+                else:
+                    splitted.extend(next(chunks_of_long))
+            print(
+                f"[v3] 文档切分完成: {len(docs)} -> {len(splitted)} 个片段 "
+                f"(直接保留 {len(docs) - len(long_docs)}, 切分 {len(long_docs)})"
+            )
             return splitted
         except Exception as e:
             print(f"[v3] 文档切分失败: {e}")
             return docs
 
+    def _split_long_documents(self, long_docs: List[Document]) -> List[List[Document]]:
+        """
+        切分长文档, 返回与 long_docs 一一对应的片段列表
+        
+        切分是纯CPU计算, 文档较多时分发到多个进程并行
+        """
+        workers = min(self.load_workers, len(long_docs))
+        if workers < 2 or len(long_docs) < self.PARALLEL_SPLIT_MIN_DOCS:
+            return [
+                _split_long_document(doc, self.text_splitter, self.fast_splitter)
+                for doc in long_docs
+            ]
+
+        print(f"[v3] 并行切分 {len(long_docs)} 个文档 ({workers} 个进程)")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_split_worker,
+            initargs=(self.chunk_size, self.chunk_overlap)
+        ) as executor:
+            return list(executor.map(_split_in_worker, long_docs, chunksize=32))
+
     def build_vectorstore(self, force_rebuild: bool = False) -> bool:
         if os.path.exists(self.persist_directory) and not force_rebuild:
             print(f"[v3] 向量数据库已存在: {self.persist_directory}, 尝试加载")
             return self.load_vectorstore()
 
         print(f"[v3] 开始构建向量数据库: {self.persist_directory}")
-        docs = self.load_documents_from_directory()
-        if not docs:
+        # 加载 -> 切分 -> 入库 全程流式, 每次只处理 STREAM_ADD_CHUNKS 个片段
+        chunk_iter = self.iter_split(self.iter_documents())
+        total = 0
+        while True:
+            batch = list(islice(chunk_iter, self.STREAM_ADD_CHUNKS))
+            if not batch:
+                break
+            if total == 0:
+                self.vectorstore = self._new_chroma(recreate_on_mismatch=True)
+            self._add_in_batches(batch)
+            total += len(batch)
+
+        if total == 0:
             print("[v3] 没有可加载的文档")
             return False
 
-        split_docs = self.split_documents(docs)
-        if not split_docs:
-            print("[v3] 文档切分失败")
-            return False
+        self._invalidate_caches(content_changed=True)
+        # 集合中可能还有此前的文档, 源文件名集合在下次使用时从向量库重新统计
+        self._sources = None
+        if os.path.exists(self._sources_path):
+            os.remove(self._sources_path)
+        print(f"[v3] 向量数据库构建成功: {self.persist_directory}")
+        return True
 
-        self.vectorstore = Chroma.from_documents(
-            documents=split_docs,
-            embedding=self.embedding_model,
-            persist_directory=self.persist_directory,
+    def _new_chroma(self, recreate_on_mismatch: bool = False) -> Chroma:
+        """
+        打开(不存在时创建)持久化的 Chroma 集合
+        
+        HNSW 参数只在创建集合时写入; 已存在的集合沿用创建时的参数 (旧库未设置时为 l2 距离),
+        距离度量与配置不一致时给出提示. recreate_on_mismatch=True (全量重建) 时删除该集合并按当前参数重建
+        """
+        client = chromadb.PersistentClient(path=self.persist_directory)
+        existing = self._existing_collection_metadata(client)
+        
+        if existing is not None:
+            space = existing.get("hnsw:space", "l2")
+            expected = self.collection_metadata["hnsw:space"]
+            if space != expected:
+                if recreate_on_mismatch:
+                    print(f"[v3] 集合 '{self.collection_name}' 距离度量为 {space}, 按 {expected} 重建")
+                    client.delete_collection(self.collection_name)
+                    existing = None
+                else:
+                    print(
+                        f"[v3] ⚠ 集合 '{self.collection_name}' 距离度量为 {space}, 与配置的 {expected} 不一致, "
+                        f"HNSW 参数未生效; 执行 /rebuild 按当前参数重建"
+                    )
+        
+        return Chroma(
+            client=client,
+            embedding_function=self.embedding_model,
             collection_name=self.collection_name,
+            # 已存在的集合不传元数据, 避免 Chroma 拒绝修改距离度量
+            collection_metadata=self.collection_metadata if existing is None else None,
         )
 
-        print(f"[v3] 向量数据库构建成功: {self.persist_directory}")
-        return True
+    def _existing_collection_metadata(self, client) -> Optional[dict]:
+        """集合已存在时返回其元数据 (无元数据为 {}), 不存在时返回 None"""
+        # 不同版本的 chromadb 中 list_collections 返回集合对象或集合名
+        names = {getattr(c, "name", c) for c in client.list_collections()}
+        if self.collection_name not in names:
+            return None
+        return client.get_collection(self.collection_name).metadata or {}
+
+    def _add_in_batches(self, docs: List[Document]):
+        """
+        分批向量化并写入向量库
+        
+        向量化在后台线程中提前一批进行, 第 N+1 批的接口请求与第 N 批的 HNSW 写入重叠
+        文本块ID由内容决定, 向量库中已存在的文本块跳过 (不再向量化)
+        """
+        batch_size = self.ingest_batch_size
+
+        # 同一ID只保留第一份 (upsert 同一批内不允许重复ID)
+        docs_by_id = {}
+        for doc in docs:
+            docs_by_id.setdefault(_chunk_doc_id(doc), doc)
+        all_ids = list(docs_by_id)
+
+        existing = set()
+        for i in range(0, len(all_ids), batch_size):
+            existing.update(
+                self.vectorstore._collection.get(ids=all_ids[i : i + batch_size], include=[])["ids"]
+            )
+        new_ids = [doc_id for doc_id in all_ids if doc_id not in existing]
+        if len(new_ids) < len(docs):
+            print(f"[v3] 跳过已入库或重复的片段: {len(docs) - len(new_ids)} 个")
+
+        batches = [
+            (new_ids[i : i + batch_size], [docs_by_id[doc_id] for doc_id in new_ids[i : i + batch_size]])
+            for i in range(0, len(new_ids), batch_size)
+        ]
+        if not batches:
+            return
+
+        def embed(batch: List[Document]) -> List[List[float]]:
+            return self.embedding_model.embed_documents([d.page_content for d in batch])
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(embed, batches[0][1])
+            for i, (ids, batch) in enumerate(batches):
+                vectors = pending.result()
+                if i + 1 < len(batches):
+                    pending = executor.submit(embed, batches[i + 1][1])
+                self._upsert_batch(ids, batch, vectors)
+                print(f"[v3] 已写入 {min((i + 1) * batch_size, len(new_ids))}/{len(new_ids)} 个片段")
+
+    def _upsert_batch(self, ids: List[str], batch: List[Document], vectors: List[List[float]]):
+        """写入一批已向量化的文档 (空元数据单独写入, 与 Chroma.add_texts 的处理一致)"""
+        collection = self.vectorstore._collection
+        with_meta = [i for i, d in enumerate(batch) if d.metadata]
+        without_meta = [i for i, d in enumerate(batch) if not d.metadata]
+
+        if with_meta:
+            collection.upsert(
+                ids=[ids[i] for i in with_meta],
+                embeddings=[vectors[i] for i in with_meta],
+                metadatas=[batch[i].metadata for i in with_meta],
+                documents=[batch[i].page_content for i in with_meta],
+            )
+        if without_meta:
+            collection.upsert(
+                ids=[ids[i] for i in without_meta],
+                embeddings=[vectors[i] for i in without_meta],
+                documents=[batch[i].page_content for i in without_meta],
+            )
+
+    def _invalidate_caches(self, content_changed: bool = False):
+        """
+        丢弃由向量库派生的内存索引/缓存
+        
+        Args:
+            content_changed: 向量库内容已变化, 同时删除持久化的 int8 索引
+        """
+        self._int8_ids = None
+        self._meta_cache = None
+        if content_changed and os.path.exists(self._int8_path):
+            try:
+                os.remove(self._int8_path)
+            except OSError as e:
+                print(f"[v3] 删除int8量化索引失败: {e}")
+
+    def _get_all_meta(self) -> Tuple[List[str], List[dict]]:
+        """读取全部文本块的 (ids, metadatas), 结果缓存到下一次增删"""
+        if self._meta_cache is None:
+            data = self.vectorstore.get(include=["metadatas"])
+            self._meta_cache = (data["ids"], [meta or {} for meta in data["metadatas"]])
+        return self._meta_cache
 
     def load_vectorstore(self) -> bool:
         try:
-            self.vectorstore = Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embedding_model,
-                collection_name=self.collection_name,
-            )
+            self.vectorstore = self._new_chroma()
+            self._invalidate_caches()
             print("[v3] 向量数据库加载成功")
             return True
         except Exception as e:
@@ -205,27 +560,105 @@ class VectorStoreV3:
             return []
 
         try:
-            # 先检索更多候选 (如果需要过滤，多取一些)
-            fetch_count = k * 3 if source_filter else k
+            query_vec = self.embedding_model.embed_query(query)
+        except Exception as e:
+            print(f"[v3] 检索失败: {e}")
+            return []
+        
+        return self.search_by_vector(
+            query_vec,
+            k=k,
+            use_mmr=use_mmr,
+            fetch_k=fetch_k,
+            source_filter=source_filter
+        )
+    
+    async def asearch(
+        self,
+        query: str,
+        k: int = 5,
+        use_mmr: bool = True,
+        fetch_k: int = 20,
+        source_filter: str = None
+    ) -> List[Document]:
+        """异步检索: 在线程中执行 search, 不阻塞事件循环 (参数与返回值同 search)"""
+        return await asyncio.to_thread(self.search, query, k, use_mmr, fetch_k, source_filter)
+
+    async def asearch_batch(
+        self,
+        queries: List[str],
+        k: int = 5,
+        use_mmr: bool = True,
+        fetch_k: int = 20,
+        source_filter: str = None
+    ) -> List[List[Document]]:
+        """
+        批量异步检索: 所有查询向量合并为一次批量请求, 各查询的向量检索在线程中并发执行
+        
+        Returns:
+            与 queries 顺序一致的文档列表
+        """
+        if not self.vectorstore:
+            print("[v3] 向量数据库未初始化")
+            return [[] for _ in queries]
+
+        try:
+            query_vecs = await asyncio.to_thread(self.embedding_model.embed_queries, queries)
+        except Exception as e:
+            print(f"[v3] 检索失败: {e}")
+            return [[] for _ in queries]
+
+        return list(await asyncio.gather(*(
+            asyncio.to_thread(self.search_by_vector, vec, k, use_mmr, fetch_k, source_filter)
+            for vec in query_vecs
+        )))
+
+    def search_by_vector(
+        self,
+        query_vec: List[float],
+        k: int = 5,
+        use_mmr: bool = True,
+        fetch_k: int = 20,
+        source_filter: str = None
+    ) -> List[Document]:
+        """
+        使用已计算好的查询向量检索相关文档 (调用方已有查询向量时避免重复计算)
+        
+        Args:
+            query_vec: 查询向量
+            k: 返回文档数量
+            use_mmr: 是否使用MMR(最大边际相关性)减少冗余
+            fetch_k: MMR模式下先获取的候选数量
+            source_filter: 可选, 按文档名筛选 (支持部分匹配)
             
-            if use_mmr and hasattr(self.vectorstore, "max_marginal_relevance_search"):
-                # 使用MMR检索,减少冗余,提高多样性
-                docs = self.vectorstore.max_marginal_relevance_search(
-                    query,
-                    k=fetch_count,
-                    fetch_k=max(fetch_k, fetch_count * 2)
-                )
-                print(f"[v3] MMR检索完成: {len(docs)} 个文档")
-            else:
-                # 回退到相似度检索
-                docs = self.vectorstore.similarity_search(query, k=fetch_count)
-                print(f"[v3] 相似度检索完成: {len(docs)} 个文档")
+        Returns:
+            文档列表
+        """
+        if not self.vectorstore:
+            print("[v3] 向量数据库未初始化")
+            return []
+
+        try:
+            # 按文档名预过滤: 匹配的源文件名作为 where 条件交给 Chroma, 检索只在目标文档内进行
+            where = None
+            if source_filter and not self.use_int8_embed:
+                where = self._source_where(source_filter)
+            
+            docs = []
+            if where is not None:
+                docs = self._search_candidates(query_vec, k, fetch_k, use_mmr, where)
+                print(f"[v3] 文档预过滤 '{source_filter}': {len(docs)} 个")
             
-            # 后过滤: 按 source 筛选
-            if source_filter and docs:
-                original_count = len(docs)
-                docs = [d for d in docs if source_filter.lower() in d.metadata.get('source', '').lower()]
-                print(f"[v3] 文档过滤 '{source_filter}': {original_count} -> {len(docs)} 个")
+            if not docs:
+                # 无预过滤条件 (或旧数据缺少 source_basename) 时检索后再过滤, 需要过滤时多取一些候选
+                fetch_count = k * 3 if source_filter else k
+                docs = self._search_candidates(query_vec, fetch_count, fetch_k, use_mmr)
+                
+                # 后过滤: 按 source 筛选
+                if source_filter and docs:
+                    original_count = len(docs)
+                    docs = [d for d in docs if source_filter.lower() in d.metadata.get('source', '').lower()]
+                    print(f"[v3] 文档过滤 '{source_filter}': {original_count} -> {len(docs)} 个")
                 
             # 最终截断到 k
             return docs[:k]
@@ -234,6 +667,210 @@ class VectorStoreV3:
             print(f"[v3] 检索失败: {e}")
             return []
     
+    def _search_candidates(
+        self,
+        query_vec: List[float],
+        fetch_count: int,
+        fetch_k: int,
+        use_mmr: bool,
+        where: Optional[dict] = None
+    ) -> List[Document]:
+        """按配置选择检索方式, 返回 fetch_count 个候选 (where 为可选的元数据过滤条件)"""
+        if self.use_int8_embed:
+            # int8 粗排 + FP32 精排 (+ MMR)
+            docs = self._int8_search(
+                query_vec,
+                k=fetch_count,
+                fetch_k=max(fetch_k, fetch_count * 2),
+                use_mmr=use_mmr
+            )
+            print(f"[v3] int8量化检索完成: {len(docs)} 个文档")
+        elif use_mmr and hasattr(self.vectorstore, "_collection"):
+            # 使用MMR检索,减少冗余,提高多样性 (候选向量一次取回, MMR在NumPy中完成)
+            docs = self._mmr_search(query_vec, k=fetch_count, fetch_k=max(fetch_k, fetch_count * 2), where=where)
+            print(f"[v3] MMR检索完成: {len(docs)} 个文档")
+        elif use_mmr and hasattr(self.vectorstore, "max_marginal_relevance_search_by_vector"):
+            docs = self.vectorstore.max_marginal_relevance_search_by_vector(
+                query_vec,
+                k=fetch_count,
+                fetch_k=max(fetch_k, fetch_count * 2),
+                filter=where
+            )
+            print(f"[v3] MMR检索完成: {len(docs)} 个文档")
+        else:
+            # 回退到相似度检索
+            docs = self.vectorstore.similarity_search_by_vector(query_vec, k=fetch_count, filter=where)
+            print(f"[v3] 相似度检索完成: {len(docs)} 个文档")
+        return docs
+
+    def _source_where(self, source_filter: str) -> Optional[dict]:
+        """把文档名部分匹配转换为 source_basename 的 where 条件, 没有匹配的源文件时返回 None"""
+        needle = source_filter.lower()
+        try:
+            matched = sorted(name for name in self._get_sources() if needle in name.lower())
+        except Exception as e:
+            print(f"[v3] 获取源文件列表失败: {e}")
+            return None
+        if not matched:
+            return None
+        if len(matched) == 1:
+            return {"source_basename": matched[0]}
+        return {"source_basename": {"$in": matched}}
+
+    def _mmr_search(
+        self,
+        query_vec: List[float],
+        k: int,
+        fetch_k: int,
+        where: Optional[dict] = None
+    ) -> List[Document]:
+        """
+        MMR检索: 由 Chroma 的 HNSW 索引取回 fetch_k 个候选及其向量, 再用 _mmr_select 选出 k 个
+        """
+        result = self.vectorstore._collection.query(
+            query_embeddings=[query_vec],
+            n_results=fetch_k,
+            where=where,
+            include=["embeddings", "documents", "metadatas"]
+        )
+        embeddings = np.asarray(result["embeddings"][0], dtype=np.float32)
+        if embeddings.size == 0:
+            return []
+
+        picked = _mmr_select(np.asarray(query_vec, dtype=np.float32), embeddings, k)
+        documents = result["documents"][0]
+        metadatas = result["metadatas"][0]
+        return [
+            Document(page_content=documents[i], metadata=metadatas[i] or {})
+            for i in picked
+        ]
+
+    def _build_int8_index(self, batch_size: int = 5000):
+        """
+        从向量库读取全部向量, 按维度缩放后量化为 int8 矩阵
+        
+        每一维的缩放系数为该维绝对值最大值 / 127, 矩阵大小约为 FP32 的 1/4
+        已有与向量库条数一致的持久化索引时直接加载
+        """
+        if self._load_int8_index():
+            return
+
+        ids: List[str] = []
+        rows = []
+        offset = 0
+        while True:
+            data = self.vectorstore.get(include=["embeddings"], limit=batch_size, offset=offset)
+            batch_ids = data.get("ids", [])
+            if not batch_ids:
+                break
+            ids.extend(batch_ids)
+            rows.append(np.asarray(data["embeddings"], dtype=np.float32))
+            if len(batch_ids) < batch_size:
+                break
+            offset += batch_size
+
+        if not ids:
+            self._int8_ids, self._int8_matrix, self._int8_scale = [], None, None
+            return
+
+        embeddings = np.vstack(rows)
+        scale = np.abs(embeddings).max(axis=0) / 127.0
+        scale[scale == 0] = 1.0
+        self._int8_matrix = np.clip(np.rint(embeddings / scale), -127, 127).astype(np.int8)
+        self._int8_scale = scale.astype(np.float32)
+        self._int8_ids = ids
+        print(f"[v3] int8量化索引构建完成: {len(ids)} 个向量")
+        self._save_int8_index()
+
+    def _save_int8_index(self):
+        """原子写入 int8 索引 (先写临时文件再替换)"""
+        tmp_path = self._int8_path + ".tmp.npz"
+        try:
+            np.savez(
+                tmp_path,
+                ids=np.asarray(self._int8_ids, dtype=str),
+                matrix=self._int8_matrix,
+                scale=self._int8_scale,
+            )
+            os.replace(tmp_path, self._int8_path)
+        except Exception as e:
+            print(f"[v3] 保存int8量化索引失败: {e}")
+
+    def _load_int8_index(self) -> bool:
+        """加载持久化的 int8 索引, 文件不存在或与向量库条数不一致时返回 False"""
+        if not os.path.exists(self._int8_path):
+            return False
+        try:
+            with np.load(self._int8_path, allow_pickle=False) as data:
+                ids = data["ids"].tolist()
+                if len(ids) != self.vectorstore._collection.count():
+                    print("[v3] int8量化索引与向量库不一致, 重新构建")
+                    return False
+                self._int8_matrix = data["matrix"]
+                self._int8_scale = data["scale"]
+            self._int8_ids = ids
+            print(f"[v3] int8量化索引加载完成: {len(ids)} 个向量")
+            return True
+        except Exception as e:
+            print(f"[v3] 加载int8量化索引失败, 重新构建: {e}")
+            return False
+
+    def _int8_search(
+        self,
+        query_vec: List[float],
+        k: int,
+        fetch_k: int,
+        use_mmr: bool
+    ) -> List[Document]:
+        """
+        int8 量化检索
+        
+        1. 用 int8 矩阵与量化查询向量做整数内积, 取前 fetch_k*4 个作为粗排候选
+        2. 从向量库取回候选的原始 FP32 向量, 按余弦相似度精排取前 fetch_k 个
+        3. 对精排结果做 MMR (或直接取前 k 个)
+        """
+        if self._int8_ids is None:
+            self._build_int8_index()
+        if not self._int8_ids:
+            return []
+
+        q = np.asarray(query_vec, dtype=np.float32)
+
+        # 查询向量乘以各维缩放系数后再整体量化, 使整数内积与原始内积成正比
+        q_scaled = q * self._int8_scale
+        q_max = np.abs(q_scaled).max()
+        if q_max == 0:
+            return []
+        q_int = np.rint(q_scaled / q_max * 127).astype(np.int32)
+        coarse_scores = self._int8_matrix @ q_int
+
+        n = min(len(self._int8_ids), fetch_k * 4)
+        shortlist = np.argpartition(-coarse_scores, n - 1)[:n]
+
+        data = self.vectorstore.get(
+            ids=[self._int8_ids[i] for i in shortlist],
+            include=["embeddings", "documents", "metadatas"]
+        )
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        if embeddings.size == 0:
+            return []
+
+        norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(q)
+        norms[norms == 0] = np.inf
+        exact_scores = embeddings @ q / norms
+        candidates = np.argsort(-exact_scores, kind="stable")[:fetch_k]
+
+        if use_mmr:
+            picked = _mmr_select(q, embeddings[candidates], k)
+            selected = [candidates[i] for i in picked]
+        else:
+            selected = candidates[:k]
+
+        return [
+            Document(page_content=data["documents"][i], metadata=data["metadatas"][i] or {})
+            for i in selected
+        ]
+
     def expand_neighbors_by_page(
         self,
         docs: List[Document],
@@ -259,12 +896,14 @@ class VectorStoreV3:
         
         # 首先添加原始文档
         for doc in docs:
-            content_hash = hash(doc.page_content)
+            content_hash = _content_key(doc.page_content)
             if content_hash not in seen_content:
                 expanded.append(doc)
                 seen_content.add(content_hash)
         
-        # 然后查找相邻页面
+        # 然后查找相邻页面: 按锚点文档与页偏移的顺序收集 (锚点, 目标页)
+        pairs = []
+        anchor_pages = []
         for doc in docs:
             source = doc.metadata.get('source')
             page = doc.metadata.get('page')
@@ -272,36 +911,63 @@ class VectorStoreV3:
             if not source or page is None:
                 continue
             
-            # 查询相邻页面
+            anchor_pages.append((source, page))
             for offset in range(-page_window, page_window + 1):
                 if offset == 0:  # 跳过当前页
                     continue
                     
                 target_page = page + offset
-                if target_page < 0:
-                    continue
-                
-                try:
-                    # 从向量库中查找同源同页的文档
-                    neighbor_docs = self.vectorstore.similarity_search(
-                        doc.page_content,  # 使用原文档内容作为查询
-                        k=3,
-                        filter={"source": source, "page": target_page}
-                    )
-                    
-                    for neighbor_doc in neighbor_docs:
-                        content_hash = hash(neighbor_doc.page_content)
-                        if content_hash not in seen_content:
-                            expanded.append(neighbor_doc)
-                            seen_content.add(content_hash)
-                            
-                            if len(expanded) >= max_total:
-                                print(f"[v3] 邻近扩展完成: {len(docs)} -> {len(expanded)} 个文档")
-                                return expanded
-                except Exception as e:
-                    # 如果filter不支持,跳过
-                    continue
+                if target_page >= 0:
+                    pairs.append((doc, (source, target_page)))
+        
+        if not pairs:
+            print(f"[v3] 邻近扩展完成: {len(docs)} -> {len(expanded)} 个文档")
+            return expanded[:max_total]
+        
+        # 按元数据一次取回目标页与锚点页的文本块及其已存储的向量 (不调用向量化模型, 也不走 HNSW 检索)
+        pages = list(dict.fromkeys([target for _, target in pairs] + anchor_pages))
+        clauses = [{"$and": [{"source": s}, {"page": p}]} for s, p in pages]
+        where = clauses[0] if len(clauses) == 1 else {"$or": clauses}
+        try:
+            data = self.vectorstore.get(
+                where=where, include=["documents", "metadatas", "embeddings"]
+            )
+        except Exception as e:
+            print(f"[v3] 邻近页面查询失败: {e}")
+            return expanded[:max_total]
+        
+        by_page = {}
+        stored_vecs = {}
+        for content, meta, vec in zip(data["documents"], data["metadatas"], data["embeddings"]):
+            meta = meta or {}
+            by_page.setdefault((meta.get("source"), meta.get("page")), []).append(
+                (Document(page_content=content, metadata=meta), vec)
+            )
+            stored_vecs[_content_key(content)] = vec
         
+        # 每个 (锚点, 目标页) 取与锚点已存储向量最相似的3个文本块; 找不到锚点向量时按入库顺序取
+        for doc, target in pairs:
+            candidates = by_page.get(target)
+            if not candidates:
+                continue
+            
+            anchor_vec = stored_vecs.get(_content_key(doc.page_content))
+            if anchor_vec is not None and len(candidates) > 3:
+                scores = QwenEmbedding.compute_similarity_batch(anchor_vec, [vec for _, vec in candidates])
+                top = np.argsort(-np.asarray(scores), kind="stable")[:3]
+                neighbor_docs = [candidates[i][0] for i in top]
+            else:
+                neighbor_docs = [neighbor_doc for neighbor_doc, _ in candidates[:3]]
+            
+            for neighbor_doc in neighbor_docs:
+                content_hash = _content_key(neighbor_doc.page_content)
+                if content_hash not in seen_content:
+                    expanded.append(neighbor_doc)
+                    seen_content.add(content_hash)
+                    
+                    if len(expanded) >= max_total:
+                        print(f"[v3] 邻近扩展完成: {len(docs)} -> {len(expanded)} 个文档")
+                        return expanded
 
         print(f"[v3] 邻近扩展完成: {len(docs)} -> {len(expanded)} 个文档")
         return expanded[:max_total]
@@ -331,14 +997,18 @@ class VectorStoreV3:
             # 这里我们假设外部负责传入正确的完整路径，或者我们在metadata里存了filename
             # 如果只给 'LDO.pdf'，但存储的是 'd:/.../LDO.pdf'
             
-            # 策略: 先get所有metadatas，找到匹配的ID，然后用ID删除
-            data = self.vectorstore.get(include=["metadatas"])
-            ids_to_delete = []
+            # 策略1: 入库时记录了 source_basename, 由 Chroma 按 where 条件查出ID (只返回ID, 不传输元数据)
+            ids_to_delete = self.vectorstore.get(
+                where={"source_basename": filename}, include=[]
+            )["ids"]
             
-            for i, meta in enumerate(data['metadatas']):
-                source = meta.get('source', '')
-                if source.endswith(filename) or os.path.basename(source) == filename:
-                    ids_to_delete.append(data['ids'][i])
+            # 策略2: 旧版本入库的文本块没有 source_basename, 回退为先get所有metadatas, 找到匹配的ID
+            if not ids_to_delete:
+                all_ids, metadatas = self._get_all_meta()
+                for i, meta in enumerate(metadatas):
+                    source = meta.get('source', '')
+                    if source.endswith(filename) or os.path.basename(source) == filename:
+                        ids_to_delete.append(all_ids[i])
             
             if ids_to_delete:
                 print(f"[v3] 找到 {len(ids_to_delete)} 个旧片段，准备删除...")
@@ -347,6 +1017,8 @@ class VectorStoreV3:
                 for i in range(0, len(ids_to_delete), batch_size):
                     batch_ids = ids_to_delete[i:i+batch_size]
                     self.vectorstore.delete(ids=batch_ids)
+                self._invalidate_caches(content_changed=True)
+                self._update_sources(remove=filename)
                 print(f"[v3] 删除完成")
                 return True
             else:
@@ -380,17 +1052,13 @@ class VectorStoreV3:
             if not split_docs:
                 return False
             
-            if self.vectorstore:
-                self.vectorstore.add_documents(split_docs)
-            else:
+            if not self.vectorstore:
                 # 只有这一个文件的新库
-                self.vectorstore = Chroma.from_documents(
-                    documents=split_docs,
-                    embedding=self.embedding_model,
-                    persist_directory=self.persist_directory,
-                    collection_name=self.collection_name,
-                )
+                self.vectorstore = self._new_chroma()
+            self._add_in_batches(split_docs)
             
+            self._invalidate_caches(content_changed=True)
+            self._update_sources(add=os.path.basename(file_path))
             print(f"[v3] 添加成功: {len(split_docs)} 个片段")
             return True
             
@@ -406,14 +1074,61 @@ class VectorStoreV3:
                 return []
         
         try:
-            # 获取所有元数据
-            data = self.vectorstore.get(include=["metadatas"])
-            seen = set()
-            for meta in data['metadatas']:
-                source = meta.get('source', '')
-                if source:
-                    seen.add(os.path.basename(source))
-            return list(seen)
+            return list(self._get_sources())
         except Exception as e:
             print(f"[v3] 获取源文件列表失败: {e}")
             return []
+
+    def _get_sources(self) -> set:
+        """已索引源文件名集合: 优先读取 sources.json, 不存在时从向量库元数据统计一次并保存"""
+        if self._sources is not None:
+            return self._sources
+
+        if os.path.exists(self._sources_path):
+            try:
+                with open(self._sources_path, 'r', encoding='utf-8') as f:
+                    self._sources = set(json.load(f))
+                return self._sources
+            except Exception as e:
+                print(f"[v3] 读取源文件列表失败, 重新统计: {e}")
+
+        # 获取所有元数据
+        _, metadatas = self._get_all_meta()
+        seen = set()
+        for meta in metadatas:
+            basename = meta.get('source_basename')
+            if basename:
+                seen.add(basename)
+                continue
+            source = meta.get('source', '')
+            if source:
+                seen.add(os.path.basename(source))
+        self._sources = seen
+        self._save_sources()
+        return seen
+
+    def _update_sources(self, add: Optional[str] = None, remove: Optional[str] = None):
+        """增删文档后同步更新源文件名集合"""
+        try:
+            sources = self._get_sources()
+            if add:
+                sources.add(add)
+            if remove:
+                sources.discard(remove)
+            self._save_sources()
+        except Exception as e:
+            # 无法更新时丢弃, 下次使用时重新统计
+            print(f"[v3] 更新源文件列表失败: {e}")
+            self._sources = None
+            if os.path.exists(self._sources_path):
+                os.remove(self._sources_path)
+
+    def _save_sources(self):
+        """原子写入 sources.json (先写临时文件再替换)"""
+        tmp_path = self._sources_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(sorted(self._sources), f, ensure_ascii=False)
+            os.replace(tmp_path, self._sources_path)
+        except Exception as e:
+            print(f"[v3] 保存源文件列表失败: {e}")